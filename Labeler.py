@@ -1,9 +1,159 @@
 # image_text_adder.py
 from PIL import Image, ImageDraw, ImageFont
 import os
-import textwrap
 import argparse
 import sys
+import io
+import time
+import json
+import csv
+import hashlib
+import zipfile
+import tarfile
+import threading
+import queue
+import select
+import signal
+import socket
+import struct
+import shutil
+import tempfile
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+
+# Константы, которые не настраиваются
+PADDING_RATIO = 0.02
+LINE_SPACING_RATIO = 0.3
+MAX_TEXT_HEIGHT_RATIO = 0.2
+MIN_FONT_SIZE = 20
+MAX_FONT_SIZE = 150
+# Ширин символов и слов на один размер шрифта (служба и наблюдение работают долго)
+MAX_CACHED_WIDTHS = 4096
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp')
+
+SORT_METHOD_NAMES = {
+    'name': 'по имени',
+    'date': 'по дате создания',
+    'capture': 'по дате съемки (EXIF)',
+    'none': 'без сортировки',
+    'archive': 'в порядке архива',
+}
+
+# Архивы, которые можно указать вместо папок --input и --output
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+# Уже сжатые форматы кладутся в zip без повторного сжатия
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+TITLE_SOURCE_NAMES = {
+    'file': 'из файла',
+    'filename': 'из имени файла',
+    'manifest': 'из манифеста подписей',
+}
+
+# Манифест подписей JSON Lines больше этого размера не загружается в память
+# целиком: хранятся только смещения строк
+CAPTION_MANIFEST_STREAM_BYTES = 256 * 1024 * 1024
+
+# Форматы, в которых сохраняется прозрачность
+ALPHA_EXTENSIONS = ('.png', '.webp', '.tiff', '.tif')
+
+# Этапы обработки одного изображения (в порядке выполнения)
+PIPELINE_STAGES = ('decode', 'resize', 'font_load', 'wrap', 'draw', 'encode', 'write')
+
+# Формат Pillow для каждого поддерживаемого расширения
+EXTENSION_FORMATS = {
+    '.jpg': 'JPEG', '.jpeg': 'JPEG',
+    '.png': 'PNG',
+    '.webp': 'WEBP',
+    '.tiff': 'TIFF', '.tif': 'TIFF',
+    '.bmp': 'BMP',
+}
+
+# Принудительный выходной формат: расширение файла
+OUTPUT_FORMAT_EXTENSIONS = {
+    'jpeg': '.jpg',
+    'png': '.png',
+    'webp': '.webp',
+    'tiff': '.tiff',
+    'bmp': '.bmp',
+}
+
+# Профили кодирования: скорость сохранения против размера файлов
+ENCODE_PROFILES = {
+    'fast': {
+        'JPEG': {'quality': 85, 'optimize': False, 'progressive': False, 'subsampling': 2},
+        'PNG': {'compress_level': 1},
+        'WEBP': {'quality': 80, 'method': 0},
+        'TIFF': {'compression': 'raw'},
+    },
+    'balanced': {
+        'JPEG': {'quality': 90, 'optimize': True, 'progressive': False, 'subsampling': 1},
+        'PNG': {'compress_level': 6},
+        'WEBP': {'quality': 85, 'method': 4},
+        'TIFF': {'compression': 'tiff_lzw'},
+    },
+    'small': {
+        'JPEG': {'quality': 80, 'optimize': True, 'progressive': True, 'subsampling': 2},
+        'PNG': {'compress_level': 9},
+        'WEBP': {'quality': 75, 'method': 6},
+        'TIFF': {'compression': 'tiff_adobe_deflate'},
+    },
+}
+
+ENCODE_PROFILE_NAMES = {
+    None: 'стандартный (настройки Pillow)',
+    'fast': 'fast (быстрое сохранение)',
+    'balanced': 'balanced (сбалансированный)',
+    'small': 'small (минимальный размер файлов)',
+}
+
+# Предустановленные цвета текста и фона
+COLORS = {
+    'черный': (0, 0, 0),
+    'белый': (255, 255, 255),
+    'красный': (255, 0, 0),
+    'оранжевый': (255, 165, 0),
+    'желтый': (255, 255, 0),
+    'зеленый': (0, 128, 0),
+    'голубой': (0, 255, 255),
+    'синий': (0, 0, 255),
+    'фиолетовый': (128, 0, 128)
+}
+
+# Файл манифеста инкрементальной обработки (хранится в выходной папке)
+MANIFEST_FILENAME = '.labeler_manifest.json'
+MANIFEST_VERSION = 1
+
+# Сводка шарда (хранится в выходной папке): .labeler_shard_2_of_4.json
+SHARD_SUMMARY_PREFIX = '.labeler_shard_'
+SHARD_METHOD_NAMES = {
+    'hash': 'по хэшу имени файла',
+    'range': 'непрерывными диапазонами',
+}
+
+# Хранилище повторов по содержимому (по умолчанию - в выходной папке)
+DEDUP_STORE_DIRNAME = '.labeler_store'
+DEDUP_READ_CHUNK = 1024 * 1024
+
+# Кэш дат съемки (в домашней папке пользователя): путь -> размер, mtime, дата из EXIF
+CAPTURE_INDEX_FILENAME = '.labeler_capture_index.json'
+CAPTURE_INDEX_VERSION = 1
+# Теги EXIF с датой съемки: DateTimeOriginal, DateTimeDigitized, DateTime (IFD0)
+# и доли секунды к ним, чтобы снимки серии не перемешивались
+EXIF_DATE_TAGS = (0x9003, 0x9004, 0x0132)
+EXIF_SUBSEC_TAGS = {0x9003: 0x9291, 0x9004: 0x9292, 0x0132: 0x9290}
+
+# Кэш покрытия символов шрифтов (в домашней папке пользователя), ключ - хэш файла шрифта
+FONT_INDEX_CACHE_FILENAME = '.labeler_font_index.json'
+FONT_INDEX_VERSION = 1
+
+# Подтаблицы cmap в порядке предпочтения: (платформа, кодировка, формат).
+# Формат 12 покрывает символы за пределами BMP (эмодзи), формат 4 - только BMP
+CMAP_SUBTABLES = [(3, 10, 12), (0, 6, 12), (0, 4, 12), (3, 1, 4), (0, 4, 4), (0, 3, 4), (0, 1, 4), (0, 0, 4)]
 
 def get_resource_path(relative_path):
     """Получает абсолютный путь к ресурсу, работает для dev и для PyInstaller"""
@@ -14,6 +164,706 @@ def get_resource_path(relative_path):
     
     return os.path.join(base_path, relative_path)
 
+def codepoints_to_ranges(codepoints):
+    """Отсортированные кодовые точки -> список диапазонов [начало, конец]"""
+    ranges = []
+    for codepoint in codepoints:
+        if ranges and ranges[-1][1] == codepoint - 1:
+            ranges[-1][1] = codepoint
+        else:
+            ranges.append([codepoint, codepoint])
+    return ranges
+
+def _read_cmap_format4(data, offset):
+    """Символы подтаблицы cmap формата 4 (сегменты BMP), у которых есть глиф"""
+    seg_count = struct.unpack_from('>H', data, offset + 6)[0] // 2
+    ends_offset = offset + 14
+    starts_offset = ends_offset + seg_count * 2 + 2
+    deltas_offset = starts_offset + seg_count * 2
+    range_offsets_offset = deltas_offset + seg_count * 2
+    ends = struct.unpack_from(f'>{seg_count}H', data, ends_offset)
+    starts = struct.unpack_from(f'>{seg_count}H', data, starts_offset)
+    deltas = struct.unpack_from(f'>{seg_count}H', data, deltas_offset)
+    range_offsets = struct.unpack_from(f'>{seg_count}H', data, range_offsets_offset)
+
+    codepoints = []
+    for i in range(seg_count):
+        start, end, delta, range_offset = starts[i], ends[i], deltas[i], range_offsets[i]
+        if start == 0xFFFF:
+            continue
+        for codepoint in range(start, end + 1):
+            if range_offset == 0:
+                glyph = (codepoint + delta) & 0xFFFF
+            else:
+                # Смещение отсчитывается от самого элемента idRangeOffset
+                glyph_offset = range_offsets_offset + i * 2 + range_offset + (codepoint - start) * 2
+                if glyph_offset + 2 > len(data):
+                    break
+                glyph = struct.unpack_from('>H', data, glyph_offset)[0]
+                if glyph:
+                    glyph = (glyph + delta) & 0xFFFF
+            if glyph:
+                codepoints.append(codepoint)
+    return codepoints_to_ranges(codepoints)
+
+def _read_cmap_format12(data, offset):
+    """Символы подтаблицы cmap формата 12 (группы по всему Unicode), у которых есть глиф"""
+    group_count = struct.unpack_from('>I', data, offset + 12)[0]
+    ranges = []
+    for i in range(group_count):
+        start, end, start_glyph = struct.unpack_from('>III', data, offset + 16 + i * 12)
+        if start_glyph == 0:
+            # Глиф 0 - "нет символа"
+            start += 1
+        if start > end:
+            continue
+        if ranges and ranges[-1][1] == start - 1:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return ranges
+
+def read_font_coverage(data):
+    """Разбор таблицы cmap шрифта TrueType/OpenType (для коллекции .ttc -
+    первого шрифта): диапазоны символов, для которых в шрифте есть глифы"""
+    offset = 0
+    if data[:4] == b'ttcf':
+        offset = struct.unpack_from('>I', data, 12)[0]
+    table_count = struct.unpack_from('>H', data, offset + 4)[0]
+    cmap_offset = None
+    for i in range(table_count):
+        tag, _, table_offset, _ = struct.unpack_from('>4sIII', data, offset + 12 + i * 16)
+        if tag == b'cmap':
+            cmap_offset = table_offset
+            break
+    if cmap_offset is None:
+        raise ValueError("в шрифте нет таблицы cmap")
+
+    subtable_count = struct.unpack_from('>H', data, cmap_offset + 2)[0]
+    subtables = {}
+    for i in range(subtable_count):
+        platform, encoding, subtable_offset = struct.unpack_from('>HHI', data, cmap_offset + 4 + i * 8)
+        subtable_format = struct.unpack_from('>H', data, cmap_offset + subtable_offset)[0]
+        subtables.setdefault((platform, encoding, subtable_format), cmap_offset + subtable_offset)
+
+    for key in CMAP_SUBTABLES:
+        if key in subtables:
+            if key[2] == 12:
+                return _read_cmap_format12(data, subtables[key])
+            return _read_cmap_format4(data, subtables[key])
+    raise ValueError("в шрифте нет подтаблицы cmap Unicode формата 4 или 12")
+
+def get_font_index_cache_path():
+    return os.path.join(os.path.expanduser('~'), FONT_INDEX_CACHE_FILENAME)
+
+def load_font_index_cache(cache_path):
+    """Кэш покрытия шрифтов: {sha1 файла шрифта: диапазоны} (пустой, если его нет или он поврежден)"""
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get('version') != FONT_INDEX_VERSION:
+        return {}
+    fonts = cache.get('fonts')
+    return fonts if isinstance(fonts, dict) else {}
+
+def save_font_index_cache(cache_path, fonts):
+    """Атомарная запись кэша; файл одного процесса не мешает другим"""
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({'version': FONT_INDEX_VERSION, 'fonts': fonts}, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Не удалось сохранить кэш покрытия шрифтов: {e}")
+
+class GlyphCoverage:
+    """Покрытие символов цепочкой шрифтов: для каждого символа - первый
+    шрифт цепочки, в котором есть его глиф. Таблицы cmap разбираются один
+    раз (с диска берется кэш по хэшу файла шрифта), дальше шрифт символа
+    определяется поиском в словаре"""
+
+    def __init__(self, font_paths, cache_path=None):
+        self.font_paths = list(font_paths)
+        cache_path = cache_path or get_font_index_cache_path()
+        cache = load_font_index_cache(cache_path)
+        changed = False
+        self._codepoints = []
+        for font_path in self.font_paths:
+            if font_path is None:
+                # Стандартный шрифт Pillow не индексируется: ему остаются символы без глифов
+                self._codepoints.append(frozenset())
+                continue
+            with open(font_path, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha1(data).hexdigest()
+            ranges = cache.get(digest)
+            if ranges is None:
+                ranges = cache[digest] = read_font_coverage(data)
+                changed = True
+            self._codepoints.append(frozenset(
+                codepoint for start, end in ranges for codepoint in range(start, end + 1)))
+        if changed:
+            save_font_index_cache(cache_path, cache)
+        # Символ -> номер шрифта в цепочке
+        self._font_indexes = {}
+
+    def font_index(self, char):
+        """Номер шрифта для символа; символы без глифа во всех шрифтах
+        (и пробелы) остаются основному шрифту"""
+        index = self._font_indexes.get(char)
+        if index is None:
+            index = 0
+            codepoint = ord(char)
+            for i, codepoints in enumerate(self._codepoints):
+                if codepoint in codepoints:
+                    index = i
+                    break
+            self._font_indexes[char] = index
+        return index
+
+    def split_runs(self, text):
+        """Разбиение текста на участки [(номер шрифта, текст)] по покрывающему шрифту.
+        Пробелы присоединяются к текущему участку"""
+        runs = []
+        current_index = None
+        start = 0
+        for position, char in enumerate(text):
+            index = current_index if char == ' ' and current_index is not None else self.font_index(char)
+            if index != current_index:
+                if current_index is not None:
+                    runs.append((current_index, text[start:position]))
+                current_index = index
+                start = position
+        if current_index is not None:
+            runs.append((current_index, text[start:]))
+        return runs
+
+class FontRegistry:
+    """Реестр шрифтов: файл шрифта ищется один раз за запуск,
+    загруженные шрифты хранятся в LRU-кэше по ключу (путь, размер).
+    С резервными шрифтами символы, которых нет в основном шрифте,
+    рисуются первым резервным шрифтом, в котором они есть"""
+
+    def __init__(self, custom_font_path=None, bold=False, fallback_fonts=(), max_cached=32):
+        self.max_cached = max_cached
+        self.hits = 0
+        self.misses = 0
+        self._fonts = OrderedDict()
+        # Реестр используется из потоков HTTP-сервиса
+        self._lock = threading.Lock()
+        self.font_path = self._resolve_font_path(custom_font_path, bold)
+        self.fallback_paths = self._resolve_fallback_paths(fallback_fonts)
+        self.coverage = None
+        if self.fallback_paths:
+            # Основной шрифт стоит в цепочке первым
+            try:
+                self.coverage = GlyphCoverage([self.font_path] + self.fallback_paths)
+            except (OSError, ValueError, struct.error) as e:
+                print(f"Ошибка чтения таблицы символов шрифта: {e}")
+                print("Резервные шрифты не используются")
+                self.fallback_paths = []
+
+    @staticmethod
+    def _can_load(font_path):
+        try:
+            ImageFont.truetype(font_path, 20)
+            return True
+        except Exception:
+            return False
+
+    def _resolve_font_path(self, custom_font_path, bold):
+        """Определение файла шрифта: пользовательский, жирный или стандартный Times"""
+        # Если указан пользовательский шрифт
+        if custom_font_path:
+            try:
+                ImageFont.truetype(custom_font_path, 20)
+                return custom_font_path
+            except Exception as e:
+                print(f"Ошибка загрузки пользовательского шрифта: {e}")
+                print("Используется стандартный шрифт")
+
+        font_paths = [
+            "times.ttf",
+            "times new roman.ttf",
+            "Times New Roman.ttf",
+            "Times.ttf",
+            get_resource_path("times.ttf")
+        ]
+
+        # Если нужен жирный шрифт, пробуем сначала жирные версии
+        if bold:
+            bold_paths = [
+                "timesbd.ttf", "timesb.ttf", "TIMESBD.TTF",
+                "times new roman bold.ttf", "Times New Roman Bold.ttf",
+                get_resource_path("timesbd.ttf")
+            ]
+            font_paths = bold_paths + font_paths
+
+        for font_path in font_paths:
+            if os.path.exists(font_path) and self._can_load(font_path):
+                return font_path
+
+        # Если шрифт все еще не найден, используем стандартный
+        print("Шрифт не найден, используется стандартный шрифт")
+        return None
+
+    def _resolve_fallback_paths(self, fallback_fonts):
+        """Резервные шрифты, которые удается загрузить"""
+        paths = []
+        for font_path in fallback_fonts:
+            if self._can_load(font_path):
+                paths.append(font_path)
+            else:
+                print(f"Резервный шрифт не загружается и пропущен: {font_path}")
+        return paths
+
+    def get_measurer(self, size):
+        """Возвращает измеритель текста для шрифта нужного размера,
+        загружая шрифт только при промахе кэша"""
+        key = (self.font_path, size)
+        with self._lock:
+            measurer = self._fonts.get(key)
+            if measurer is not None:
+                self.hits += 1
+                self._fonts.move_to_end(key)
+                return measurer
+
+            self.misses += 1
+            if self.font_path is None:
+                font = ImageFont.load_default()
+            else:
+                font = ImageFont.truetype(self.font_path, size)
+
+            if self.coverage is None:
+                measurer = TextMeasurer(font)
+            else:
+                fonts = [font if font_path == self.font_path else ImageFont.truetype(font_path, size)
+                         for font_path in self.coverage.font_paths]
+                measurer = FallbackTextMeasurer(fonts, self.coverage)
+            self._fonts[key] = measurer
+            if len(self._fonts) > self.max_cached:
+                self._fonts.popitem(last=False)
+            return measurer
+
+    def get_font(self, size):
+        """Возвращает шрифт нужного размера"""
+        return self.get_measurer(size).font
+
+class WidthCache:
+    """LRU-кэш ширин текста, ограниченный по числу записей"""
+
+    def __init__(self, max_items=MAX_CACHED_WIDTHS):
+        self.max_items = max_items
+        self._widths = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, text, measure):
+        with self._lock:
+            width = self._widths.get(text)
+            if width is not None:
+                self._widths.move_to_end(text)
+                return width
+        width = measure(text)
+        with self._lock:
+            self._widths[text] = width
+            if len(self._widths) > self.max_items:
+                self._widths.popitem(last=False)
+        return width
+
+class TextMeasurer:
+    """Измерение и перенос текста по реальной ширине глифов шрифта.
+    Ширины символов и слов кэшируются, поэтому повторные заголовки
+    переносятся без обращений к FreeType"""
+
+    def __init__(self, font):
+        self.font = font
+        self.space_width = font.getlength(' ')
+        self._char_widths = WidthCache()
+        self._word_widths = WidthCache()
+        self._line_height = None
+
+    def _measure(self, text):
+        return self.font.getlength(text)
+
+    def char_width(self, char):
+        return self._char_widths.get(char, self._measure)
+
+    def word_width(self, word):
+        return self._word_widths.get(word, self._measure)
+
+    def line_height(self):
+        """Высота строки по габаритам образца текста (без межстрочного интервала)"""
+        if self._line_height is None:
+            bbox = self.font.getbbox("Test")
+            self._line_height = bbox[3] - bbox[1]
+        return self._line_height
+
+    def ink_width(self, line):
+        """Ширина закрашенной области строки (для центрирования)"""
+        bbox = self.font.getbbox(line)
+        return bbox[2] - bbox[0]
+
+    def draw(self, draw, position, line, fill):
+        """Отрисовка строки; position - левый верхний угол"""
+        draw.text(position, line, fill=fill, font=self.font)
+
+    def _split_word(self, word, max_width):
+        """Разбиение слова, которое не помещается в строку целиком, по символам"""
+        pieces = []
+        current = ""
+        current_width = 0
+        for char in word:
+            width = self.char_width(char)
+            if current and current_width + width > max_width:
+                pieces.append(current)
+                current = ""
+                current_width = 0
+            current += char
+            current_width += width
+        if current:
+            pieces.append(current)
+        return pieces
+
+    def wrap(self, text, max_width):
+        """Перенос текста по словам; слово разрывается, только если оно
+        само по себе шире строки"""
+        lines = []
+        current = []
+        current_width = 0
+
+        for word in text.split():
+            width = self.word_width(word)
+
+            if width > max_width:
+                if current:
+                    lines.append(' '.join(current))
+                pieces = self._split_word(word, max_width)
+                lines.extend(pieces[:-1])
+                current = [pieces[-1]]
+                current_width = self.word_width(pieces[-1])
+                continue
+
+            if current and current_width + self.space_width + width > max_width:
+                lines.append(' '.join(current))
+                current = [word]
+                current_width = width
+            elif current:
+                current.append(word)
+                current_width += self.space_width + width
+            else:
+                current = [word]
+                current_width = width
+
+        if current:
+            lines.append(' '.join(current))
+        return lines
+
+class FallbackTextMeasurer(TextMeasurer):
+    """Измерение и отрисовка текста цепочкой шрифтов: строка разбивается на
+    участки по шрифту, в котором есть глифы, участки измеряются и рисуются
+    подряд на общей базовой линии. Перенос - тот же, что у TextMeasurer"""
+
+    def __init__(self, fonts, coverage):
+        super().__init__(fonts[0])
+        self.fonts = fonts
+        self.coverage = coverage
+        # Базовая линия основного шрифта: по ней выравниваются все участки
+        self.ascent = fonts[0].getmetrics()[0]
+
+    def _measure(self, text):
+        return sum(self.fonts[index].getlength(run) for index, run in self.coverage.split_runs(text))
+
+    def ink_width(self, line):
+        left = right = None
+        x = 0
+        for index, run in self.coverage.split_runs(line):
+            font = self.fonts[index]
+            bbox = font.getbbox(run)
+            if bbox[2] > bbox[0]:
+                left = x + bbox[0] if left is None else left
+                right = x + bbox[2]
+            x += font.getlength(run)
+        return right - left if left is not None else 0
+
+    def draw(self, draw, position, line, fill):
+        x, y = position
+        for index, run in self.coverage.split_runs(line):
+            font = self.fonts[index]
+            draw.text((x, y + self.ascent), run, fill=fill, font=font, anchor='ls')
+            x += font.getlength(run)
+
+class CaptionCache:
+    """LRU-кэш готовых полос с подписью, ограниченный по объему памяти.
+    Повторяющиеся заголовки на изображениях одинаковой ширины
+    отрисовываются один раз, дальше полоса просто вставляется"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._strips = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _strip_bytes(strip):
+        return strip.width * strip.height * len(strip.getbands())
+
+    def get(self, key):
+        with self._lock:
+            entry = self._strips.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._strips.move_to_end(key)
+            return entry
+
+    def put(self, key, strip, caption):
+        size = self._strip_bytes(strip)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            # Полосу мог уже положить другой поток
+            if key in self._strips:
+                return
+            self._strips[key] = (strip, caption)
+            self.used_bytes += size
+            # Вытесняем давно не использованные полосы
+            while self.used_bytes > self.max_bytes:
+                _, (old_strip, _) = self._strips.popitem(last=False)
+                self.used_bytes -= self._strip_bytes(old_strip)
+
+class RenderContext:
+    """Кэши одного процесса: шрифты и готовые полосы подписей"""
+
+    def __init__(self, custom_font_path=None, bold=False, fallback_fonts=()):
+        self.fonts = FontRegistry(custom_font_path, bold, fallback_fonts)
+        self.captions = CaptionCache()
+
+    def stats(self):
+        return {
+            'fonts': (self.fonts.hits, self.fonts.misses),
+            'captions': (self.captions.hits, self.captions.misses),
+        }
+
+class LabelStyle:
+    """Оформление подписи: размер текста, цвета, шрифт, жирность и позиция"""
+
+    def __init__(self, text_size_ratio=0.03, text_color=(0, 0, 0), background_color=(255, 255, 255),
+                 position='bottom', font_path=None, bold=False, auto_fit=False, fallback_fonts=()):
+        if position not in ('top', 'bottom'):
+            raise ValueError(f"Неизвестная позиция текста: {position}")
+        self.text_size_ratio = text_size_ratio
+        self.text_color = tuple(text_color)
+        self.background_color = tuple(background_color)
+        self.position = position
+        self.font_path = font_path
+        self.bold = bold
+        # Уменьшать шрифт длинных подписей, чтобы они помещались в MAX_TEXT_HEIGHT_RATIO
+        self.auto_fit = auto_fit
+        # Шрифты для символов, которых нет в основном (по порядку)
+        self.fallback_fonts = tuple(fallback_fonts)
+
+    def to_dict(self):
+        return {
+            'text_size_ratio': self.text_size_ratio,
+            'text_color': self.text_color,
+            'background_color': self.background_color,
+            'position': self.position,
+            'font_path': self.font_path,
+            'bold': self.bold,
+            'auto_fit': self.auto_fit,
+            'fallback_fonts': self.fallback_fonts,
+        }
+
+    def replace(self, **changes):
+        """Копия оформления с измененными параметрами"""
+        values = self.to_dict()
+        values.update(changes)
+        return LabelStyle(**values)
+
+    def __eq__(self, other):
+        return isinstance(other, LabelStyle) and self.to_dict() == other.to_dict()
+
+    def __hash__(self):
+        return hash(tuple(self.to_dict().items()))
+
+    def __repr__(self):
+        params = ', '.join(f"{key}={value!r}" for key, value in self.to_dict().items())
+        return f"LabelStyle({params})"
+
+# Кэши процесса по шрифту: живут между вызовами, поэтому повторные
+# обращения к API в одном процессе не загружают шрифты заново
+_render_contexts = {}
+_render_contexts_lock = threading.Lock()
+
+def get_render_context(font_path=None, bold=False, fallback_fonts=()):
+    """Общий для процесса набор кэшей для шрифта, жирности и резервных шрифтов"""
+    fallback_fonts = tuple(fallback_fonts)
+    key = (font_path, bold, fallback_fonts)
+    context = _render_contexts.get(key)
+    if context is None:
+        with _render_contexts_lock:
+            context = _render_contexts.get(key)
+            if context is None:
+                context = _render_contexts[key] = RenderContext(font_path, bold, fallback_fonts)
+    return context
+
+def get_render_stats():
+    """Суммарная статистика кэшей всех наборов процесса"""
+    totals = {'fonts': (0, 0), 'captions': (0, 0)}
+    for context in _render_contexts.values():
+        for name, (hits, misses) in context.stats().items():
+            totals[name] = (totals[name][0] + hits, totals[name][1] + misses)
+    return totals
+
+def get_peak_rss():
+    """Пиковое потребление памяти текущим процессом в байтах (None, если недоступно)"""
+    try:
+        import resource
+    except ImportError:
+        resource = None
+
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS возвращает байты, Linux - килобайты
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    if os.name == 'nt':
+        try:
+            import ctypes
+            from ctypes import wintypes
+
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [
+                    ('cb', wintypes.DWORD),
+                    ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t),
+                    ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t),
+                    ('PeakPagefileUsage', ctypes.c_size_t),
+                ]
+
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(counters)
+            get_current_process = ctypes.windll.kernel32.GetCurrentProcess
+            get_current_process.restype = wintypes.HANDLE
+            get_memory_info = ctypes.windll.psapi.GetProcessMemoryInfo
+            get_memory_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), wintypes.DWORD]
+            if get_memory_info(get_current_process(), ctypes.byref(counters), counters.cb):
+                return counters.PeakWorkingSetSize
+        except Exception:
+            pass
+
+    return None
+
+class StageTimer:
+    """Замер длительности этапов обработки одного изображения.
+    Каждая отметка закрывает этап: время с предыдущей отметки
+    прибавляется к указанному этапу"""
+
+    def __init__(self):
+        self.durations = {}
+        self._last = time.perf_counter()
+
+    def start(self):
+        self._last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.durations[stage] = self.durations.get(stage, 0.0) + (now - self._last)
+        self._last = now
+
+class NullTimer:
+    """Заглушка таймера, когда замеры не нужны"""
+
+    def start(self):
+        pass
+
+    def mark(self, stage):
+        pass
+
+NULL_TIMER = NullTimer()
+
+def percentile(sorted_values, fraction):
+    """Перцентиль по отсортированному списку (ближайший ранг)"""
+    if not sorted_values:
+        return 0.0
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+class RunMetrics:
+    """Метрики запуска: построчная запись по каждому изображению в JSON Lines
+    и итоговая таблица p50/p95/max по этапам"""
+
+    def __init__(self, metrics_path=None):
+        self.samples = {stage: [] for stage in PIPELINE_STAGES + ('total',)}
+        self.images = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.pixels = 0
+        self.started = time.perf_counter()
+        self._file = open(metrics_path, "w", encoding="utf-8") if metrics_path else None
+
+    def add(self, result):
+        stages = result.get('stages') or {}
+        if self._file is not None:
+            record = {
+                'filename': result['filename'],
+                'output_filename': result['output_filename'],
+                'error': result['error'],
+                'pid': result['pid'],
+                'input_bytes': result['input_bytes'],
+                'output_bytes': result['output_bytes'],
+                'pixels': result['pixels'],
+                'font_size': result.get('font_size'),
+                'truncated_lines': result.get('truncated_lines'),
+                'stages': stages,
+            }
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+        if result['error'] is not None:
+            return
+        self.images += 1
+        self.input_bytes += result['input_bytes']
+        self.output_bytes += result['output_bytes']
+        self.pixels += result['pixels']
+        for stage in PIPELINE_STAGES:
+            self.samples[stage].append(stages.get(stage, 0.0))
+        self.samples['total'].append(sum(stages.values()))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def print_summary(self):
+        elapsed = time.perf_counter() - self.started
+        print("Время по этапам, мс:")
+        print(f"  {'этап':<10} {'p50':>9} {'p95':>9} {'max':>9}")
+        for stage, values in self.samples.items():
+            values = sorted(values)
+            print(f"  {stage:<10} {percentile(values, 0.5) * 1000:9.1f} "
+                  f"{percentile(values, 0.95) * 1000:9.1f} {(values[-1] if values else 0.0) * 1000:9.1f}")
+        if elapsed > 0:
+            megabytes = 1024 * 1024
+            print(f"Производительность: {self.images / elapsed:.2f} изобр./с, "
+                  f"чтение {self.input_bytes / megabytes / elapsed:.2f} МБ/с, "
+                  f"запись {self.output_bytes / megabytes / elapsed:.2f} МБ/с, "
+                  f"{self.pixels / 1e6 / elapsed:.1f} Мп/с")
+
+def format_cache_stats(name, hits, misses):
+    total = hits + misses
+    rate = hits * 100.0 / total if total else 0.0
+    return f"Кэш {name}: {hits} попаданий, {misses} промахов ({rate:.0f}%)"
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Добавление текста к изображениям')
     parser.add_argument('--input', '-i', default='photos', 
@@ -26,14 +876,88 @@ def parse_arguments():
                        help='Позиция текста: top (сверху) или bottom (снизу) (по умолчанию: bottom)')
     parser.add_argument('--bold', '-b', action='store_true',
                        help='Сделать текст жирным')
+    parser.add_argument('--auto-fit', action='store_true',
+                       help='Уменьшать шрифт длинных подписей, чтобы они помещались целиком '
+                            f'(не больше {int(MAX_TEXT_HEIGHT_RATIO * 100)}%% высоты изображения)')
+    parser.add_argument('--fallback-font', dest='fallback_fonts', action='append', default=None,
+                       metavar='ФАЙЛ',
+                       help='Резервный шрифт .ttf для символов, которых нет в основном '
+                            '(греческий, символы, эмодзи); можно указать несколько, порядок важен')
     parser.add_argument('--auto-extend', '-a', action='store_true',
                        help='Автоматически расширять последний заголовок без подтверждения')
     parser.add_argument('--interactive', '-I', action='store_true',
                        help='Запустить в интерактивном режиме')
-    parser.add_argument('--sort-by', '-s', choices=['name', 'date'], default='name',
-                       help='Сортировка изображений: name (по имени) или date (по дате создания)')
+    parser.add_argument('--sort-by', '-s', choices=list(SORT_METHOD_NAMES), default='name',
+                       help='Сортировка изображений: name (по имени), date (по дате создания), '
+                            'capture (по дате съемки из EXIF, без EXIF - по дате изменения), '
+                            'none (в порядке обхода папки, обработка начинается сразу) '
+                            'или archive (в порядке файлов в архиве, только для входного архива)')
+    parser.add_argument('--recursive', '-r', action='store_true',
+                       help='Обрабатывать вложенные папки, повторяя их структуру в выходной папке')
     parser.add_argument('--use-filename', '-u', action='store_true',
                        help='Использовать имена файлов как заголовки вместо файла titles.txt')
+    parser.add_argument('--captions', '-c', default=None,
+                       help='Манифест подписей (CSV или JSON Lines): имя файла -> подпись '
+                            'и необязательное оформление; заменяет titles.txt')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                       help='Количество рабочих процессов (0 - по числу ядер, по умолчанию: 1)')
+    parser.add_argument('--encode-profile', '-e', choices=list(ENCODE_PROFILES), default=None,
+                       help='Профиль кодирования результатов: fast (быстро), balanced или small (меньше размер) '
+                            '(по умолчанию: настройки Pillow)')
+    parser.add_argument('--format', '-f', dest='output_format', choices=list(OUTPUT_FORMAT_EXTENSIONS), default=None,
+                       help='Сохранять все результаты в одном формате независимо от расширения исходника')
+    parser.add_argument('--max-width', type=int, default=None,
+                       help='Максимальная ширина результата в пикселях; большие изображения '
+                            'уменьшаются (JPEG декодируется сразу в уменьшенном масштабе)')
+    parser.add_argument('--max-height', type=int, default=None,
+                       help='Максимальная высота фотографии в результате (без полосы подписи)')
+    parser.add_argument('--variant', dest='variants', action='append', default=None,
+                       metavar='СУФФИКС:РАЗМЕР[:ФОРМАТ[:КАЧЕСТВО]]',
+                       help='Дополнительный уменьшенный вариант результата, например web:1600:jpeg:85 '
+                            'или thumb:320:webp (можно указать несколько раз)')
+    parser.add_argument('--profile', action='store_true',
+                       help='Замерять этапы обработки и вывести таблицу p50/p95/max в конце')
+    parser.add_argument('--metrics-file', default=None,
+                       help='Записывать метрики каждого изображения в файл JSON Lines (включает --profile)')
+    parser.add_argument('--prefetch', '-P', type=int, default=0,
+                       help='Конвейерная обработка в одном процессе: сколько изображений читать '
+                            'и записывать с опережением (0 - без конвейера, по умолчанию: 0)')
+    parser.add_argument('--shard', default=None, metavar='НОМЕР/КОЛИЧЕСТВО',
+                       help='Обработать только свою часть пакета, например 2/4 (номера с 1)')
+    parser.add_argument('--shard-by', choices=list(SHARD_METHOD_NAMES), default='hash',
+                       help='Разбиение на шарды: hash - по хэшу имени файла, '
+                            'range - непрерывными диапазонами списка (по умолчанию: hash)')
+    parser.add_argument('--merge-shards', nargs='+', default=None, metavar='ПУТЬ',
+                       help='Объединить сводки шардов (файлы или папки результатов) в общий отчет')
+    parser.add_argument('--merge-report', default=None,
+                       help='Файл JSON для общего отчета --merge-shards')
+    parser.add_argument('--watch', action='store_true',
+                       help='Наблюдать за входной папкой и подписывать новые изображения по мере появления')
+    parser.add_argument('--settle', type=float, default=1.0,
+                       help='Сколько секунд файл должен не меняться, чтобы считаться записанным '
+                            '(режим наблюдения, по умолчанию: 1)')
+    parser.add_argument('--dry-run', action='store_true',
+                       help='Пробный запуск: прочитать только заголовки изображений и показать '
+                            'размеры результатов, переносы и обрезку подписей без записи файлов')
+    parser.add_argument('--plan-file', default=None,
+                       help='Файл для плана пробного запуска (.csv или .json)')
+    parser.add_argument('--serve', action='store_true',
+                       help='Запустить HTTP-сервис подписей вместо обработки папки '
+                            '(размер пула отрисовки задается --workers)')
+    parser.add_argument('--host', default='127.0.0.1',
+                       help='Адрес HTTP-сервиса (по умолчанию: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080,
+                       help='Порт HTTP-сервиса (по умолчанию: 8080)')
+    parser.add_argument('--queue-limit', type=int, default=64,
+                       help='Максимум ожидающих запросов, сверх него сервис отвечает 503 (по умолчанию: 64)')
+    parser.add_argument('--dedup', action='store_true',
+                       help='Не обрабатывать заново одинаковые по содержимому изображения с той же подписью: '
+                            'результат берется из хранилища жесткой ссылкой или копией')
+    parser.add_argument('--dedup-store', default=None,
+                       help=f'Папка хранилища повторов, общая для разных запусков (включает --dedup; '
+                            f'по умолчанию: {DEDUP_STORE_DIRNAME} в папке результатов)')
+    parser.add_argument('--incremental', '-n', action='store_true',
+                       help='Пропускать изображения, результат для которых уже актуален (по манифесту в выходной папке)')
     return parser.parse_args()
 
 def ask_confirmation(question):
@@ -132,17 +1056,7 @@ def select_percentage(prompt, default=3, options=[3,4,5,6,7,8,9]):
 
 def select_color(prompt, default_color, color_type="текста"):
     """Выбор цвета из предустановленных вариантов"""
-    colors = {
-        'черный': (0, 0, 0),
-        'белый': (255, 255, 255),
-        'красный': (255, 0, 0),
-        'оранжевый': (255, 165, 0),
-        'желтый': (255, 255, 0),
-        'зеленый': (0, 128, 0),
-        'голубой': (0, 255, 255),
-        'синий': (0, 0, 255),
-        'фиолетовый': (128, 0, 128)
-    }
+    colors = COLORS
     
     color_names = list(colors.keys())
     default_name = 'черный' if default_color == (0,0,0) else 'белый'
@@ -208,17 +1122,17 @@ def select_position(prompt, default='bottom'):
 
 def select_sort_method(prompt, default='name'):
     """Выбор метода сортировки"""
-    methods = ['по имени', 'по дате создания']
-    default_text = 'по имени' if default == 'name' else 'по дате создания'
+    default_text = SORT_METHOD_NAMES[default]
     
     print(f"\n{prompt}")
     print("Методы сортировки изображений:")
     print("  1. по имени")
     print("  2. по дате создания")
+    print("  3. по дате съемки из EXIF (для файлов без EXIF - по дате изменения)")
     
     while True:
         try:
-            choice = input(f"Выберите метод сортировки (1-2) [по умолчанию {default_text}]: ").strip()
+            choice = input(f"Выберите метод сортировки (1-3) [по умолчанию {default_text}]: ").strip()
             if not choice:
                 return default
             
@@ -227,24 +1141,26 @@ def select_sort_method(prompt, default='name'):
                 return 'name'
             elif choice_num == 2:
                 return 'date'
+            elif choice_num == 3:
+                return 'capture'
             else:
-                print("Пожалуйста, выберите 1 или 2")
+                print("Пожалуйста, выберите 1, 2 или 3")
         except ValueError:
             print("Пожалуйста, введите число")
 
 def select_title_source(prompt, default='file'):
     """Выбор источника заголовков"""
-    sources = ['из файла', 'из имени файла']
-    default_text = 'из файла' if default == 'file' else 'из имени файла'
+    default_text = TITLE_SOURCE_NAMES[default]
     
     print(f"\n{prompt}")
     print("Источник заголовков:")
     print("  1. из файла titles.txt")
     print("  2. из имени файла изображения")
+    print("  3. из манифеста подписей (CSV или JSON Lines: имя файла -> подпись)")
     
     while True:
         try:
-            choice = input(f"Выберите источник заголовков (1-2) [по умолчанию {default_text}]: ").strip()
+            choice = input(f"Выберите источник заголовков (1-3) [по умолчанию {default_text}]: ").strip()
             if not choice:
                 return default
             
@@ -253,8 +1169,10 @@ def select_title_source(prompt, default='file'):
                 return 'file'
             elif choice_num == 2:
                 return 'filename'
+            elif choice_num == 3:
+                return 'manifest'
             else:
-                print("Пожалуйста, выберите 1 или 2")
+                print("Пожалуйста, выберите 1, 2 или 3")
         except ValueError:
             print("Пожалуйста, введите число")
 
@@ -294,180 +1212,2513 @@ def select_font():
         except ValueError:
             print("Пожалуйста, введите число")
 
-def get_image_files_sorted(folder_path, sort_method='name'):
-    """Получение списка изображений с сортировкой (ИСПРАВЛЕННАЯ ВЕРСИЯ)"""
-    image_extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp')
-    image_files = []
-    
-    # Получаем все файлы в папке
-    all_files = os.listdir(folder_path)
-    
-    for filename in all_files:
-        # Проверяем расширение файла (без учета регистра)
-        if filename.lower().endswith(image_extensions):
-            image_files.append(filename)
-    
+def scan_image_entries(folder_path, recursive=False, exclude_dirs=(), prefix=''):
+    """Потоковый обход папки через os.scandir.
+    Возвращает пары (относительный путь, DirEntry); данные stat из DirEntry
+    переиспользуются при сортировке"""
+    subdirs = []
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.is_file():
+                # Проверяем расширение файла (без учета регистра)
+                if entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.join(prefix, entry.name), entry
+            elif recursive and entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry)
+
+    # Вложенные папки обходим после закрытия текущей, чтобы не держать много дескрипторов
+    for entry in subdirs:
+        if os.path.realpath(entry.path) in exclude_dirs:
+            continue
+        yield from scan_image_entries(entry.path, True, exclude_dirs, os.path.join(prefix, entry.name))
+
+def iter_image_files(folder_path, recursive=False, exclude_dirs=()):
+    """Изображения в порядке обхода папки, без ожидания окончания сканирования"""
+    for rel_path, _ in scan_image_entries(folder_path, recursive, exclude_dirs):
+        yield rel_path
+
+def get_image_files_sorted(folder_path, sort_method='name', recursive=False, exclude_dirs=()):
+    """Получение списка изображений с сортировкой"""
+    entries = list(scan_image_entries(folder_path, recursive, exclude_dirs))
+
     if sort_method == 'name':
-        # Сортировка по имени файла
-        image_files.sort()
+        # Сортировка по имени файла (с учетом вложенных папок)
+        entries.sort(key=lambda item: item[0])
     elif sort_method == 'date':
-        # Сортировка по дате создания (сначала старые)
-        image_files.sort(key=lambda x: os.path.getctime(os.path.join(folder_path, x)))
-    
-    return image_files
+        # Сортировка по дате создания (сначала старые), stat берется из DirEntry
+        entries.sort(key=lambda item: item[1].stat().st_ctime)
+    elif sort_method == 'capture':
+        # Сортировка по дате съемки; при равных датах - по имени
+        capture_times = get_capture_times(entries)
+        entries.sort(key=lambda item: (capture_times[item[0]], item[0]))
 
-def get_titles_from_filenames(image_files):
-    """Создание заголовков из имен файлов"""
-    titles = []
-    for filename in image_files:
-        # Убираем расширение файла
-        name_without_ext = os.path.splitext(filename)[0]
-        # Заменяем подчеркивания и дефисы на пробелы для лучшей читаемости
-        clean_name = name_without_ext.replace('_', ' ').replace('-', ' ')
-        titles.append(clean_name)
-    return titles
+    return [rel_path for rel_path, _ in entries]
 
-def interactive_mode():
-    """Интерактивный режим настройки параметров"""
-    print("=" * 60)
-    print("        РЕЖИМ НАСТРОЙКИ ПАРАМЕТРОВ")
-    print("=" * 60)
-    
-    # Создаем объект для хранения настроек
-    class Config:
-        pass
-    
-    config = Config()
-    
-    # Настройка путей к файлам
-    print("\nШАГ 1: Настройка путей к файлам")
-    config.input = get_input_path("Папка с изображениями:", "photos", "folder")
-    config.output = get_input_path("Папка для результатов:", "output", "folder")
-    
-    # Настройка источника заголовков
-    config.title_source = select_title_source("Источник заголовков для изображений:")
-    
-    if config.title_source == 'file':
-        config.titles = get_input_path("Файл с заголовками:", "titles.txt", "file")
-        # Проверяем, что файл с заголовками существует
-        if config.titles and not os.path.exists(config.titles):
-            print("Файл с заголовками не существует. Создайте его или укажите правильный путь.")
-            return None
-    else:
-        config.titles = None
-    
-    # Настройка метода сортировки
-    config.sort_by = select_sort_method("Сортировка изображений")
-    
-    # Настройка шрифта
-    config.custom_font_path, config.font_name = select_font()
-    
-    # Настройка размера текста
-    config.text_size_ratio = select_percentage(
-        "Размер текста относительно высоты изображения:",
-        default=3
-    )
-    
-    # Настройка цвета текста
-    config.text_color = select_color(
-        "Цвет текста:",
-        default_color=(0, 0, 0),
-        color_type="текста"
-    )
-    
-    # Настройка жирности текста
-    config.bold = select_yes_no("Жирный текст?", default=False)
-    
-    # Настройка позиции текста
-    config.position = select_position("Позиция текста:")
-    
-    # Настройка цвета фона
-    config.background_color = select_color(
-        "Цвет фона текстовой области:",
-        default_color=(255, 255, 255),
-        color_type="фона"
-    )
-    
-    # Настройка автоматического расширения (только для файловых заголовков)
-    if config.title_source == 'file':
-        config.auto_extend = select_yes_no("Автоматически расширять последний заголовок?", default=False)
+def parse_exif_datetime(value, subsec=None):
+    """Дата EXIF "ГГГГ:ММ:ДД ЧЧ:ММ:СС" -> секунды эпохи (местное время) или None"""
+    try:
+        text = value.split(b'\0', 1)[0].decode('ascii').strip()
+        parsed = time.strptime(text, '%Y:%m:%d %H:%M:%S')
+        seconds = time.mktime(parsed)
+    except (ValueError, OverflowError, UnicodeDecodeError):
+        # Пустые и нулевые даты ("0000:00:00 00:00:00") встречаются часто
+        return None
+    if subsec:
+        digits = subsec.split(b'\0', 1)[0].strip()
+        if digits.isdigit():
+            seconds += int(digits) / 10 ** len(digits)
+    return seconds
+
+def read_tiff_capture_time(read):
+    """Дата съемки из структуры TIFF/EXIF. read(смещение, размер) читает байты
+    относительно начала заголовка TIFF: читаются только нужные каталоги и значения"""
+    header = read(0, 8)
+    if header[:4] == b'II*\0':
+        order = '<'
+    elif header[:4] == b'MM\0*':
+        order = '>'
     else:
-        config.auto_extend = False
-    
-    return config
+        return None
 
-def main():
-    # Получаем аргументы командной строки
-    args = parse_arguments()
+    def read_ifd(offset):
+        """Теги каталога: {тег: (тип, количество, поле значения)}"""
+        count_data = read(offset, 2)
+        if len(count_data) < 2:
+            return {}
+        count = struct.unpack(order + 'H', count_data)[0]
+        data = read(offset + 2, count * 12)
+        tags = {}
+        for i in range(len(data) // 12):
+            tag, value_type, value_count = struct.unpack_from(order + 'HHI', data, i * 12)
+            tags[tag] = (value_type, value_count, data[i * 12 + 8:i * 12 + 12])
+        return tags
 
-    # Если запрошен интерактивный режим, запускаем его
-    if args.interactive or len(sys.argv) == 1:
-        config = interactive_mode()
-        
-        if config is None:
-            print("Настройка отменена.")
-            return
-        
-        # Показываем сводку настроек
-        print("\n" + "=" * 60)
-        print("        СВОДКА НАСТРОЕК")
-        print("=" * 60)
-        print(f"Папка с изображениями: {config.input}")
-        print(f"Папка для результатов: {config.output}")
-        print(f"Источник заголовков: {'из файла' if config.title_source == 'file' else 'из имени файла'}")
-        if config.title_source == 'file':
-            print(f"Файл с заголовками: {config.titles}")
-        print(f"Сортировка: {'по имени' if config.sort_by == 'name' else 'по дате создания'}")
-        print(f"Шрифт: {'Стандартный Times' if config.custom_font_path is None else 'Пользовательский: ' + config.font_name}")
-        print(f"Размер текста: {config.text_size_ratio * 100}% от высоты изображения")
-        print(f"Цвет текста: {config.text_color}")
-        print(f"Жирный текст: {'Да' if config.bold else 'Нет'}")
-        print(f"Позиция текста: {'верх' if config.position == 'top' else 'низ'}")
-        print(f"Цвет фона: {config.background_color}")
-        if config.title_source == 'file':
-            print(f"Авторасширение: {'Да' if config.auto_extend else 'Нет'}")
-        print("=" * 60)
-        
-        if not ask_confirmation("Начать обработку с этими настройками?"):
-            print("Обработка отменена.")
-            return
-    else:
-        # Используем настройки из аргументов командной строки
-        config = args
-        # Устанавливаем значения по умолчанию для параметров, не заданных через аргументы
-        config.text_size_ratio = 0.03  # 3%
-        config.text_color = (0, 0, 0)  # черный
-        config.background_color = (255, 255, 255)  # белый
-        config.custom_font_path = None
-        config.font_name = "times.ttf"
-        config.title_source = 'filename' if args.use_filename else 'file'
+    def read_ascii(entry):
+        value_type, value_count, field = entry
+        if value_type != 2:
+            return None
+        if value_count <= 4:
+            return field[:value_count]
+        return read(struct.unpack(order + 'I', field)[0], min(value_count, 64))
 
-    # Константы, которые не настраиваются
-    PADDING_RATIO = 0.02
-    LINE_SPACING_RATIO = 0.3
-    MAX_TEXT_HEIGHT_RATIO = 0.2
-    MIN_FONT_SIZE = 20
-    MAX_FONT_SIZE = 150
+    ifd0 = read_ifd(struct.unpack(order + 'I', header[4:8])[0])
+    tags = dict(ifd0)
+    exif_pointer = ifd0.get(0x8769)
+    if exif_pointer is not None:
+        tags.update(read_ifd(struct.unpack(order + 'I', exif_pointer[2])[0]))
+    for tag in EXIF_DATE_TAGS:
+        if tag in tags:
+            subsec_tag = EXIF_SUBSEC_TAGS[tag]
+            subsec = read_ascii(tags[subsec_tag]) if subsec_tag in tags else None
+            seconds = parse_exif_datetime(read_ascii(tags[tag]) or b'', subsec)
+            if seconds is not None:
+                return seconds
+    return None
 
-    # Проверяем существование необходимых папок
-    if not os.path.exists(config.input):
-        print(f"Ошибка: Папка '{config.input}' не существует!")
-        input("Нажмите Enter для выхода...")
-        return
+def _read_buffer(data, base=0):
+    return lambda offset, size: data[base + offset:base + offset + size]
 
-    # Создаем выходную папку
-    os.makedirs(config.output, exist_ok=True)
+def read_capture_time(path):
+    """Дата съемки из EXIF без декодирования изображения: читаются только
+    заголовки JPEG (сегмент APP1), чанки PNG и WebP или каталоги TIFF.
+    Возвращает секунды эпохи или None, если даты нет"""
+    with open(path, 'rb') as f:
+        head = f.read(12)
+        if head[:2] == b'\xff\xd8':
+            # JPEG: маркеры до начала данных изображения (SOS)
+            f.seek(2)
+            while True:
+                marker = f.read(4)
+                if len(marker) < 4 or marker[0] != 0xFF or marker[1] == 0xDA:
+                    return None
+                length = struct.unpack('>H', marker[2:])[0]
+                if marker[1] == 0xE1:
+                    segment = f.read(length - 2)
+                    if segment[:6] == b'Exif\0\0':
+                        return read_tiff_capture_time(_read_buffer(segment, 6))
+                else:
+                    f.seek(length - 2, os.SEEK_CUR)
+        if head[:4] in (b'II*\0', b'MM\0*'):
+            def read(offset, size):
+                f.seek(offset)
+                return f.read(size)
+            return read_tiff_capture_time(read)
+        if head[:8] == b'\x89PNG\r\n\x1a\n':
+            # PNG: чанк eXIf обычно стоит перед данными изображения
+            f.seek(8)
+            while True:
+                chunk = f.read(8)
+                if len(chunk) < 8 or chunk[4:] in (b'IDAT', b'IEND'):
+                    return None
+                length = struct.unpack('>I', chunk[:4])[0]
+                if chunk[4:] == b'eXIf':
+                    return read_tiff_capture_time(_read_buffer(f.read(length)))
+                f.seek(length + 4, os.SEEK_CUR)
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            # WebP: чанк EXIF стоит после данных изображения, но чанки пропускаются без чтения
+            while True:
+                chunk = f.read(8)
+                if len(chunk) < 8:
+                    return None
+                length = struct.unpack('<I', chunk[4:])[0]
+                if chunk[:4] == b'EXIF':
+                    data = f.read(length)
+                    return read_tiff_capture_time(_read_buffer(data, 6 if data[:6] == b'Exif\0\0' else 0))
+                f.seek(length + (length & 1), os.SEEK_CUR)
+    return None
 
-    # Получаем список изображений с сортировкой
-    image_files = get_image_files_sorted(config.input, config.sort_by)
-    
-    if not image_files:
-        print(f"В папке '{config.input}' не найдено изображений!")
-        input("Нажмите Enter для выхода...")
-        return
+def _read_capture_time_safe(path):
+    try:
+        return read_capture_time(path)
+    except (OSError, struct.error):
+        return None
 
-    # Получаем заголовки в зависимости от выбранного источника
+def load_capture_index(index_path):
+    """Кэш дат съемки (пустой, если его нет или он поврежден)"""
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(index, dict) or index.get('version') != CAPTURE_INDEX_VERSION:
+        return {}
+    entries = index.get('entries')
+    return entries if isinstance(entries, dict) else {}
+
+def save_capture_index(index_path, entries):
+    """Атомарная запись кэша дат съемки"""
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({'version': CAPTURE_INDEX_VERSION, 'entries': entries}, f, separators=(',', ':'))
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        print(f"Не удалось сохранить кэш дат съемки: {e}")
+
+def get_capture_times(entries, index_path=None):
+    """Даты съемки для пар (относительный путь, DirEntry): из EXIF, а для
+    файлов без даты - время изменения (или создания, если оно раньше).
+    Заголовки новых и измененных файлов читаются параллельно, результаты
+    кэшируются на диске по пути, размеру и времени изменения файла"""
+    index_path = index_path or os.path.join(os.path.expanduser('~'), CAPTURE_INDEX_FILENAME)
+    index = load_capture_index(index_path)
+    capture_times = {}
+    pending = []
+    for rel_path, entry in entries:
+        stat = entry.stat()
+        path = os.path.abspath(entry.path)
+        cached = index.get(path)
+        fallback = min(stat.st_mtime, stat.st_ctime)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            capture_times[rel_path] = cached[2] if cached[2] is not None else fallback
+        else:
+            pending.append((rel_path, path, stat, fallback))
+
+    if pending:
+        # Чтение заголовков упирается в диск, а не в процессор: хватает потоков
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            found = executor.map(_read_capture_time_safe, [path for _, path, _, _ in pending])
+            for (rel_path, path, stat, fallback), seconds in zip(pending, found):
+                index[path] = [stat.st_size, stat.st_mtime_ns, seconds]
+                capture_times[rel_path] = seconds if seconds is not None else fallback
+        save_capture_index(index_path, index)
+        print(f"Прочитаны даты съемки: {len(pending)} файлов, из кэша: {len(capture_times) - len(pending)}")
+    return capture_times
+
+def get_title_from_filename(filename):
+    """Создание заголовка из имени файла"""
+    # Убираем папку и расширение файла
+    name_without_ext = os.path.splitext(os.path.basename(filename))[0]
+    # Заменяем подчеркивания и дефисы на пробелы для лучшей читаемости
+    return name_without_ext.replace('_', ' ').replace('-', ' ')
+
+def get_titles_from_filenames(image_files):
+    """Создание заголовков из имен файлов"""
+    return [get_title_from_filename(filename) for filename in image_files]
+
+def is_archive_path(path):
+    """Путь указывает на архив zip или tar, а не на папку"""
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+def is_safe_member_name(name):
+    """Имя файла в архиве не выходит за пределы папки результатов"""
+    parts = name.replace('\\', '/').split('/')
+    return not name.startswith(('/', '\\')) and '..' not in parts and ':' not in parts[0]
+
+class ArchiveSource:
+    """Изображения из архива zip или tar без распаковки на диск.
+
+    Zip читается в любом порядке через оглавление. Tar читается потоком
+    вперед: read() и open_member() нужно вызывать в порядке архива, поэтому
+    обработка всегда идет в этом порядке, а сортировка влияет только на
+    сопоставление заголовков"""
+
+    def __init__(self, path):
+        self.path = path
+        self.is_zip = path.lower().endswith('.zip')
+        self._zip = zipfile.ZipFile(path) if self.is_zip else None
+        self._tar = None
+        self._current = None
+
+    @staticmethod
+    def _is_image(name):
+        return name.lower().endswith(IMAGE_EXTENSIONS) and is_safe_member_name(name)
+
+    def list_members(self):
+        """Отдельный проход по архиву: [(имя, время изменения)] в порядке архива"""
+        if self.is_zip:
+            return [(info.filename, time.mktime(info.date_time + (0, 0, -1)))
+                    for info in self._zip.infolist()
+                    if not info.is_dir() and self._is_image(info.filename)]
+        with tarfile.open(self.path, 'r:*') as tar:
+            return [(member.name, member.mtime) for member in tar
+                    if member.isfile() and self._is_image(member.name)]
+
+    def _next_member(self):
+        if self._tar is None:
+            self._tar = tarfile.open(self.path, 'r|*')
+        # next() продолжает с текущего места потока, а новый итератор по
+        # TarFile начал бы заново с первого файла
+        member = self._tar.next()
+        while member is not None and not (member.isfile() and self._is_image(member.name)):
+            member = self._tar.next()
+        self._current = member
+        return member
+
+    def iter_names(self):
+        """Имена изображений в порядке архива без предварительного прохода"""
+        if self.is_zip:
+            for name, _ in self.list_members():
+                yield name
+            return
+        while self._next_member() is not None:
+            yield self._current.name
+
+    def open_member(self, name):
+        """Файловый объект для чтения изображения из архива"""
+        if self.is_zip:
+            return self._zip.open(name)
+        # Поток tar только движется вперед до нужного файла
+        while self._current is None or self._current.name != name:
+            if self._next_member() is None:
+                raise KeyError(f"В архиве нет файла (или порядок чтения нарушен): {name}")
+        return self._tar.extractfile(self._current)
+
+    def read(self, name):
+        with self.open_member(name) as f:
+            return f.read()
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+        if self._tar is not None:
+            self._tar.close()
+
+class ArchiveSink:
+    """Запись результатов в архив zip или tar по мере готовности.
+    Архив пишется во временный файл рядом и переименовывается при закрытии"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.part'
+        lower = path.lower()
+        if lower.endswith('.zip'):
+            self._zip = zipfile.ZipFile(self.tmp_path, 'w', allowZip64=True)
+            self._tar = None
+        else:
+            compression = ''
+            for suffixes, name in ((('.gz', '.tgz'), 'gz'), (('.bz2', '.tbz2'), 'bz2'), (('.xz', '.txz'), 'xz')):
+                if lower.endswith(suffixes):
+                    compression = name
+            self._zip = None
+            self._tar = tarfile.open(self.tmp_path, 'w|' + compression)
+        self.count = 0
+
+    def write(self, name, data):
+        name = name.replace(os.sep, '/')
+        if self._zip is not None:
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            stored = name.lower().endswith(STORED_EXTENSIONS)
+            info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+            self._zip.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            self._tar.addfile(info, io.BytesIO(data))
+        self.count += 1
+
+    def close(self):
+        (self._zip or self._tar).close()
+        os.replace(self.tmp_path, self.path)
+
+def get_archive_members_sorted(source, sort_method='name'):
+    """Изображения архива в порядке сортировки (для сопоставления заголовков)
+    и в порядке архива (для чтения)"""
+    members = source.list_members()
+    archive_order = [name for name, _ in members]
+    if sort_method == 'name':
+        members = sorted(members, key=lambda item: item[0])
+    elif sort_method in ('date', 'capture'):
+        # В архиве дата съемки не читается: используется дата файла в архиве
+        members = sorted(members, key=lambda item: item[1])
+    return [name for name, _ in members], archive_order
+
+def normalize_manifest_key(filename):
+    """Имя файла в манифесте подписей: путь относительно входной папки через /"""
+    key = filename.replace('\\', '/')
+    while key.startswith('./'):
+        key = key[2:]
+    return key
+
+class CaptionManifest:
+    """Манифест подписей: имя файла -> подпись и необязательное оформление.
+
+    CSV с колонками filename и caption (или title) либо JSON Lines с теми же
+    полями. Необязательные поля position, bold, text_color, background_color и
+    text_size_ratio переопределяют оформление для отдельного изображения.
+    Большой файл JSON Lines не загружается целиком: индекс хранит смещение
+    строки для каждого имени, запись читается при обращении"""
+
+    def __init__(self, path, streaming=None):
+        self.path = path
+        self.is_csv = path.lower().endswith('.csv')
+        if streaming is None:
+            streaming = not self.is_csv and os.path.getsize(path) > CAPTION_MANIFEST_STREAM_BYTES
+        # Построчные смещения возможны только для JSON Lines: в CSV поле может занимать несколько строк
+        self.streaming = streaming and not self.is_csv
+        self.duplicates = 0
+        self._index = {}
+        self._used = set()
+        self._file = None
+        if self.streaming:
+            self._build_offsets()
+        elif self.is_csv:
+            self._load_csv()
+        else:
+            self._load_jsonl()
+
+    def __len__(self):
+        return len(self._index)
+
+    @staticmethod
+    def _parse_key(record, line_number):
+        """Ключ (нормализованное имя файла) записи манифеста"""
+        if not isinstance(record, dict):
+            raise ValueError(f"строка {line_number}: ожидается объект с полями filename и caption")
+        filename = record.get('filename')
+        if not filename:
+            raise ValueError(f"строка {line_number}: нет имени файла")
+        return normalize_manifest_key(filename)
+
+    @staticmethod
+    def _parse_record(record, line_number):
+        """(подпись, переопределения оформления) из записи манифеста"""
+        caption = record.get('caption', record.get('title'))
+        if caption is None:
+            raise ValueError(f"строка {line_number}: нет подписи")
+
+        overrides = {}
+        try:
+            if record.get('position') not in (None, ''):
+                if record['position'] not in ('top', 'bottom'):
+                    raise ValueError(f"неизвестная позиция текста: {record['position']}")
+                overrides['position'] = record['position']
+            if record.get('bold') not in (None, ''):
+                overrides['bold'] = parse_bool(record['bold'])
+            for field in ('text_color', 'background_color'):
+                value = record.get(field)
+                if value in (None, ''):
+                    continue
+                overrides[field] = parse_color(value) if isinstance(value, str) else tuple(value)
+            if record.get('text_size_ratio') not in (None, ''):
+                overrides['text_size_ratio'] = float(record['text_size_ratio'])
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"строка {line_number}: {e}")
+        return str(caption).strip(), overrides
+
+    def _add(self, key, value):
+        if key in self._index:
+            # Повтор имени файла: побеждает последняя запись
+            self.duplicates += 1
+        self._index[key] = value
+
+    def _add_record(self, record, line_number, value=None):
+        """Запись в индекс. Ошибка в подписи или оформлении сохраняется под
+        именем файла и поднимается только при обращении к этой подписи:
+        одна неверная строка не останавливает всю пакетную обработку"""
+        key = self._parse_key(record, line_number)
+        try:
+            entry = self._parse_record(record, line_number)
+        except ValueError as e:
+            self._add(key, e)
+            return
+        self._add(key, entry if value is None else value)
+
+    def _load_csv(self):
+        with open(self.path, 'r', encoding='utf-8-sig', newline='') as f:
+            reader = csv.DictReader(f)
+            for record in reader:
+                self._add_record(record, reader.line_num)
+
+    def _load_jsonl(self):
+        with open(self.path, 'r', encoding='utf-8-sig') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                self._add_record(json.loads(line), line_number)
+
+    def _build_offsets(self):
+        with open(self.path, 'rb') as f:
+            line_number = 0
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                line_number += 1
+                if not line.strip():
+                    continue
+                self._add_record(json.loads(line.decode('utf-8-sig')), line_number, (offset, line_number))
+
+    def get(self, filename):
+        """(подпись, переопределения оформления) для файла или None, если его нет в манифесте"""
+        key = normalize_manifest_key(filename)
+        value = self._index.get(key)
+        if value is None:
+            return None
+        self._used.add(key)
+        if isinstance(value, ValueError):
+            raise value
+        if not self.streaming:
+            return value
+
+        offset, line_number = value
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+        self._file.seek(offset)
+        return self._parse_record(json.loads(self._file.readline().decode('utf-8-sig')), line_number)
+
+    def unused(self):
+        """Имена файлов из манифеста, для которых не нашлось изображений"""
+        return [key for key in self._index if key not in self._used]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def get_render_settings(config):
+    """Параметры пакетной обработки, которые передаются в рабочие процессы"""
+    return {
+        'input': config.input,
+        'output': config.output,
+        'style': config.style,
+        'encode_profile': getattr(config, 'encode_profile', None),
+        'output_format': getattr(config, 'output_format', None),
+        'profile': getattr(config, 'profile', False) or bool(getattr(config, 'metrics_file', None)),
+        'variants': getattr(config, 'variants', None) or [],
+        'output_archive': is_archive_path(config.output),
+        'max_size': get_max_size(config),
+        'dedup_store': get_dedup_store(config),
+    }
+
+def get_dedup_store(config):
+    """Папка хранилища повторов или None, если поиск повторов выключен.
+    Для архива-результата хранилище по умолчанию создается на время запуска"""
+    if getattr(config, 'dedup_store', None):
+        return config.dedup_store
+    if not getattr(config, 'dedup', False) or is_archive_path(config.output):
+        return None
+    return os.path.join(config.output, DEDUP_STORE_DIRNAME)
+
+def get_max_size(config):
+    """Ограничение размера результата (ширина, высота) или None; 0 - без ограничения"""
+    max_width = getattr(config, 'max_width', None) or None
+    max_height = getattr(config, 'max_height', None) or None
+    if max_width is None and max_height is None:
+        return None
+    return (max_width, max_height)
+
+def get_capped_size(size, max_size):
+    """Размер изображения после уменьшения до ограничения с сохранением пропорций"""
+    width, height = size
+    if max_size is None:
+        return size
+    max_width, max_height = max_size
+    scale = min(1.0, (max_width or width) / width, (max_height or height) / height)
+    if scale >= 1.0:
+        return size
+    return (max(1, round(width * scale)), max(1, round(height * scale)))
+
+def get_output_filename(filename, output_format=None):
+    """Имя выходного файла для исходного изображения"""
+    name, ext = os.path.splitext(filename)
+    if output_format:
+        ext = OUTPUT_FORMAT_EXTENSIONS[output_format]
+    return f"{name}_labeled{ext}"
+
+class OutputVariant:
+    """Дополнительный вариант результата: уменьшенная копия со своим
+    форматом, качеством и суффиксом имени (фото_labeled_web.jpg).
+    Задается строкой СУФФИКС:РАЗМЕР[:ФОРМАТ[:КАЧЕСТВО]], где РАЗМЕР -
+    ограничение длинной стороны в пикселях (0 - без уменьшения)"""
+
+    def __init__(self, suffix, max_size=None, output_format=None, quality=None):
+        if not suffix or not all(char.isalnum() or char in '-_' for char in suffix):
+            raise ValueError(f"Неверный суффикс варианта: {suffix!r}")
+        if max_size is not None and max_size < 1:
+            raise ValueError(f"Неверный размер варианта: {max_size}")
+        if output_format is not None and output_format not in OUTPUT_FORMAT_EXTENSIONS:
+            raise ValueError(f"Неизвестный формат варианта: {output_format}")
+        if quality is not None and not 1 <= quality <= 100:
+            raise ValueError(f"Качество варианта должно быть от 1 до 100: {quality}")
+        self.suffix = suffix
+        self.max_size = max_size
+        self.output_format = output_format
+        self.quality = quality
+
+    @classmethod
+    def parse(cls, spec):
+        """Вариант из строки вида web:1600:jpeg:85 или thumb:320"""
+        parts = spec.split(':')
+        if not 2 <= len(parts) <= 4:
+            raise ValueError(f"Вариант задается как СУФФИКС:РАЗМЕР[:ФОРМАТ[:КАЧЕСТВО]]: {spec}")
+        parts += [''] * (4 - len(parts))
+        suffix, max_size, output_format, quality = parts
+        try:
+            max_size = int(max_size) or None
+            quality = int(quality) if quality else None
+        except ValueError:
+            raise ValueError(f"Размер и качество варианта должны быть числами: {spec}")
+        return cls(suffix, max_size, output_format.lower() or None, quality)
+
+    def get_output_filename(self, filename, output_format=None):
+        name, ext = os.path.splitext(get_output_filename(filename, self.output_format or output_format))
+        return f"{name}_{self.suffix}{ext}"
+
+    def get_size(self, size):
+        """Размер изображения варианта (без полосы подписи)"""
+        width, height = size
+        if self.max_size is None or max(width, height) <= self.max_size:
+            return size
+        scale = self.max_size / max(width, height)
+        return (max(1, round(width * scale)), max(1, round(height * scale)))
+
+    def fit(self, img):
+        """Уменьшение изображения до ограничения длинной стороны"""
+        size = self.get_size(img.size)
+        if size == img.size:
+            return img
+        # reducing_gap: сначала быстрое целочисленное уменьшение, затем сглаживание
+        return img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+    def to_spec(self):
+        return ':'.join([self.suffix, str(self.max_size or 0), self.output_format or '',
+                         str(self.quality or '')]).rstrip(':')
+
+    def describe(self):
+        size = f"до {self.max_size} px" if self.max_size else "исходный размер"
+        details = [size, self.output_format or 'формат основного результата']
+        if self.quality:
+            details.append(f"качество {self.quality}")
+        return f"{self.suffix} ({', '.join(details)})"
+
+    def __repr__(self):
+        return f"OutputVariant({self.to_spec()!r})"
+
+def get_save_options(output_ext, encode_profile):
+    """Параметры кодировщика Pillow для выбранного профиля"""
+    if encode_profile is None:
+        return {}
+    image_format = EXTENSION_FORMATS.get(output_ext)
+    return dict(ENCODE_PROFILES[encode_profile].get(image_format, {}))
+
+def get_settings_hash(settings, style=None):
+    """Хэш параметров, влияющих на результат отрисовки"""
+    style = style or settings['style']
+    values = dict(style.to_dict(), encode_profile=settings['encode_profile'],
+                  output_format=settings['output_format'])
+    if not values['auto_fit']:
+        del values['auto_fit']
+    if values['fallback_fonts']:
+        values['fallback_fonts'] = list(values['fallback_fonts'])
+    else:
+        del values['fallback_fonts']
+    # Без автоподбора, вариантов и ограничения размера хэш совпадает с хэшем прежних версий манифеста
+    if settings.get('variants'):
+        values['variants'] = [variant.to_spec() for variant in settings['variants']]
+    if settings.get('max_size'):
+        values['max_size'] = list(settings['max_size'])
+    data = json.dumps(values, sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+def get_source_signature(img_path):
+    """Размер и время изменения исходного файла"""
+    stat = os.stat(img_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def load_manifest(output_folder, filename=MANIFEST_FILENAME):
+    """Загрузка манифеста предыдущего запуска (пустой, если его нет или он поврежден)"""
+    manifest_path = os.path.join(output_folder, filename)
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest.get('entries', {})
+
+def save_manifest(output_folder, entries, filename=MANIFEST_FILENAME):
+    """Атомарная запись манифеста"""
+    manifest_path = os.path.join(output_folder, filename)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({'version': MANIFEST_VERSION, 'entries': entries}, f, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+def make_manifest_entry(signature, text, settings_hash, output_filename, variant_filenames=()):
+    entry = dict(signature, title=text, settings=settings_hash, output=output_filename)
+    if variant_filenames:
+        entry['variants'] = list(variant_filenames)
+    return entry
+
+def link_or_copy(source, target):
+    """Жесткая ссылка на файл, а если она невозможна (другой диск, FAT) - копия.
+    Существующий файл заменяется атомарно"""
+    if os.path.exists(target) and os.path.samefile(source, target):
+        # Уже ссылка на этот файл; os.replace между ссылками на один файл
+        # ничего не делает и оставил бы временный файл
+        return
+    if os.path.dirname(target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    try:
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+
+class DedupStore:
+    """Хранилище готовых результатов по содержимому исходника. Ключ -
+    хэш (содержимое исходника, подпись, оформление, форматы результатов);
+    результаты связаны с выходными файлами жесткими ссылками. Файл
+    сведений <ключ>.json записывается последним и отмечает готовую запись"""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def _path(self, key, suffix):
+        return os.path.join(self.folder, key[:2], key + suffix)
+
+    @staticmethod
+    def make_key(content_hash, text, filenames, style, settings):
+        extensions = [os.path.splitext(filename)[1].lower() for filename in filenames]
+        values = [content_hash, text, get_settings_hash(settings, style), extensions]
+        return hashlib.sha1(json.dumps(values, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def lookup(self, key):
+        """Сведения о готовом результате или None"""
+        try:
+            with open(self._path(key, '.json'), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            # Файлы хранилища могли удалить или перезаписать вне программы
+            for suffix, size in zip(meta['files'], meta['sizes']):
+                if os.path.getsize(self._path(key, suffix)) != size:
+                    return None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return meta
+
+    def restore(self, key, meta, filenames, settings):
+        """Готовые результаты: ссылки в выходной папке или байты для архива-результата"""
+        files = []
+        for suffix, filename in zip(meta['files'], filenames):
+            source = self._path(key, suffix)
+            if settings.get('output_archive'):
+                with open(source, 'rb') as f:
+                    files.append((filename, f.read()))
+            else:
+                link_or_copy(source, os.path.join(settings['output'], filename))
+        return files
+
+    def publish(self, key, info, settings, seconds):
+        """Сохранение только что записанных результатов под ключом"""
+        filenames = [info['output_filename']] + info['variant_filenames']
+        suffixes = [f"_{i}{os.path.splitext(filename)[1].lower()}" for i, filename in enumerate(filenames)]
+        os.makedirs(os.path.dirname(self._path(key, '')), exist_ok=True)
+        if settings.get('output_archive'):
+            for suffix, (_, data) in zip(suffixes, info['files']):
+                tmp_path = self._path(key, f"{suffix}.{os.getpid()}.tmp")
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, self._path(key, suffix))
+        else:
+            for suffix, filename in zip(suffixes, filenames):
+                link_or_copy(os.path.join(settings['output'], filename), self._path(key, suffix))
+
+        meta = {
+            'files': suffixes,
+            'sizes': [os.path.getsize(self._path(key, suffix)) for suffix in suffixes],
+            'seconds': seconds,
+            'line_count': info['line_count'],
+            'font_size': info['font_size'],
+            'truncated_lines': info['truncated_lines'],
+            'pixels': info['pixels'],
+        }
+        tmp_path = self._path(key, f".{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._path(key, '.json'))
+
+def is_output_current(entry, signature, text, settings_hash, output_folder):
+    """Проверка, что сохраненный результат соответствует исходнику, заголовку и настройкам"""
+    if entry is None:
+        return False
+    return (entry.get('size') == signature['size']
+            and entry.get('mtime_ns') == signature['mtime_ns']
+            and entry.get('title') == text
+            and entry.get('settings') == settings_hash
+            and all(os.path.exists(os.path.join(output_folder, output))
+                    for output in [entry.get('output', '')] + entry.get('variants', [])))
+
+class ShardSpec:
+    """Часть пакета для одного узла: шард index из count (номера с 1).
+
+    По хэшу (hash) изображение попадает в шард по SHA-1 своего относительного
+    пути: назначение не зависит от сортировки и от появления других файлов.
+    Диапазонами (range) шард получает непрерывный отрезок отсортированного
+    списка. Заголовок выбирается по позиции в полном списке, поэтому
+    соответствие titles.txt сохраняется при любом разбиении"""
+
+    def __init__(self, index, count, method='hash'):
+        if count < 1 or not 1 <= index <= count:
+            raise ValueError(f"Неверный шард: {index}/{count}")
+        if method not in SHARD_METHOD_NAMES:
+            raise ValueError(f"Неизвестный способ разбиения: {method}")
+        self.index = index
+        self.count = count
+        self.method = method
+
+    @classmethod
+    def parse(cls, value, method='hash'):
+        """Шард из строки INDEX/COUNT"""
+        try:
+            index, count = (int(part) for part in value.split('/'))
+        except ValueError:
+            raise ValueError(f"Шард задается как НОМЕР/КОЛИЧЕСТВО, например 2/4: {value}")
+        return cls(index, count, method)
+
+    def contains(self, position, filename, total=None):
+        """Принадлежит ли шарду изображение с номером position в полном списке"""
+        if self.method == 'range':
+            start = (self.index - 1) * total // self.count
+            end = self.index * total // self.count
+            return start <= position < end
+        key = normalize_manifest_key(filename).encode('utf-8')
+        digest = hashlib.sha1(key).digest()
+        return int.from_bytes(digest[:8], 'big') % self.count == self.index - 1
+
+    def suffix(self):
+        return f"{self.index}_of_{self.count}"
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+def save_shard_summary(output_folder, shard, summary):
+    """Атомарная запись сводки шарда; возвращает путь к файлу"""
+    path = os.path.join(output_folder, f"{SHARD_SUMMARY_PREFIX}{shard.suffix()}.json")
+    tmp_path = path + '.tmp'
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+    return path
+
+def find_shard_summaries(paths):
+    """Файлы сводок: указанные явно и найденные в указанных папках"""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.startswith(SHARD_SUMMARY_PREFIX) and name.endswith('.json')))
+        else:
+            found.append(path)
+    return found
+
+def merge_shard_summaries(summaries):
+    """Общий отчет по сводкам шардов: суммы, ошибки и недостающие шарды"""
+    report = {
+        'shards': sorted(summary['shard'] for summary in summaries),
+        'total': 0,
+        'processed': 0,
+        'skipped': 0,
+        'failed': [],
+        'unmatched': [],
+        'elapsed_seconds': 0.0,
+        'problems': [],
+    }
+    counts = {summary['shard'][1] for summary in summaries}
+    methods = {summary['method'] for summary in summaries}
+    if len(counts) > 1 or len(methods) > 1:
+        report['problems'].append("сводки относятся к разным разбиениям")
+
+    seen = set()
+    for summary in summaries:
+        index, count = summary['shard']
+        if (index, count) in seen:
+            report['problems'].append(f"шард {index}/{count} встречается несколько раз")
+            continue
+        seen.add((index, count))
+        for field in ('total', 'processed', 'skipped'):
+            report[field] += summary[field]
+        report['failed'].extend(summary['failed'])
+        report['unmatched'].extend(summary.get('unmatched', []))
+        # Шарды работают параллельно: общее время - время самого долгого
+        report['elapsed_seconds'] = max(report['elapsed_seconds'], summary['elapsed_seconds'])
+
+    for count in counts:
+        missing = [index for index in range(1, count + 1) if (index, count) not in seen]
+        if missing:
+            report['problems'].append(
+                f"нет сводок шардов: {', '.join(f'{index}/{count}' for index in missing)}")
+    return report
+
+def merge_shards(paths, report_path=None):
+    """Команда объединения сводок шардов в общий отчет"""
+    summaries = []
+    for path in find_shard_summaries(paths):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                summaries.append(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"Ошибка при чтении сводки '{path}': {e}")
+    if not summaries:
+        print("Сводки шардов не найдены!")
+        return None
+
+    report = merge_shard_summaries(summaries)
+    print("-" * 50)
+    print(f"Шардов: {len(summaries)}")
+    print(f"Изображений: {report['total']}, обработано: {report['processed']}, "
+          f"пропущено без изменений: {report['skipped']}, ошибок: {len(report['failed'])}")
+    if report['unmatched']:
+        print(f"Без подписи в манифесте: {len(report['unmatched'])}")
+    print(f"Время самого долгого шарда: {report['elapsed_seconds']:.1f} с")
+    for failure in report['failed'][:10]:
+        print(f"  Ошибка: {failure['filename']}: {failure['error']}")
+    if len(report['failed']) > 10:
+        print(f"  ... и еще {len(report['failed']) - 10}")
+    for problem in report['problems']:
+        print(f"ВНИМАНИЕ: {problem}")
+
+    if report_path:
+        try:
+            with open(report_path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=1)
+            print(f"Общий отчет сохранен в '{report_path}'")
+        except OSError as e:
+            print(f"Ошибка при сохранении отчета: {e}")
+    return report
+
+def get_canvas_mode(img, output_ext, style):
+    """Режим итогового изображения: исходный режим сохраняется, если его
+    поддерживает выходной формат и в нем можно нарисовать выбранные цвета.
+    Если формат еще не известен (output_ext=None), прозрачность сохраняется"""
+    mode = img.mode
+    has_alpha = mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+
+    if has_alpha and (output_ext is None or output_ext in ALPHA_EXTENSIONS):
+        return 'RGBA'
+    if mode == 'L':
+        # Оттенки серого оставляем, только если текст и фон тоже серые
+        colors = (style.text_color, style.background_color)
+        if all(color[0] == color[1] == color[2] for color in colors):
+            return 'L'
+    # Палитру не сохраняем: в ней может не оказаться цветов подписи
+    return 'RGB'
+
+def get_mode_color(color, mode):
+    """Цвет (R, G, B) в представлении режима изображения"""
+    if mode == 'L':
+        return color[0]
+    if mode == 'RGBA':
+        return tuple(color) + (255,)
+    return tuple(color)
+
+def get_caption_metrics(img_height, style):
+    """Адаптивные размеры подписи для изображения заданной высоты:
+    (размер шрифта, отступ, межстрочный интервал, максимальная высота блока)"""
+    base_font_size = int(img_height * style.text_size_ratio)
+    font_size = max(MIN_FONT_SIZE, min(MAX_FONT_SIZE, base_font_size))
+
+    padding = int(img_height * PADDING_RATIO)
+    line_spacing = int(font_size * LINE_SPACING_RATIO)
+    max_text_height = int(img_height * MAX_TEXT_HEIGHT_RATIO)
+    return font_size, padding, line_spacing, max_text_height
+
+def _layout_at_size(text, img_width, font_size, padding, max_text_height, context, timer=NULL_TIMER):
+    """Раскладка подписи шрифтом заданного размера"""
+    # Берем шрифт из реестра (загружается один раз на каждый размер)
+    measurer = context.fonts.get_measurer(font_size)
+    timer.mark('font_load')
+
+    # Определяем максимальную ширину для текста (с отступами)
+    max_text_width = img_width - 2 * padding
+
+    # Разбиваем текст на строки по реальной ширине слов
+    wrapped_lines = measurer.wrap(text, max_text_width)
+    timer.mark('wrap')
+
+    # Вычисляем высоту текстового блока
+    line_height = measurer.line_height() + int(font_size * LINE_SPACING_RATIO)
+    full_height = len(wrapped_lines) * line_height + 2 * padding
+    # Строки, которые целиком помещаются в ограничение высоты
+    visible = max(0, (max_text_height - 2 * padding) // line_height) if line_height else len(wrapped_lines)
+
+    return {
+        'measurer': measurer,
+        'font_size': font_size,
+        'padding': padding,
+        'line_height': line_height,
+        'lines': wrapped_lines,
+        'full_height': full_height,
+        # Ограничиваем максимальную высоту текстового блока
+        'height': min(full_height, max_text_height),
+        'clipped': full_height > max_text_height,
+        'truncated': max(0, len(wrapped_lines) - visible) if full_height > max_text_height else 0,
+    }
+
+def layout_caption(text, img_width, img_height, style, context, timer=NULL_TIMER):
+    """Раскладка подписи без отрисовки: строки, их высота и высота полосы.
+    Нужны только размеры изображения, поэтому раскладку можно считать по заголовку файла.
+
+    При style.auto_fit подпись, которая не помещается в MAX_TEXT_HEIGHT_RATIO,
+    раскладывается наибольшим подходящим шрифтом не меньше MIN_FONT_SIZE.
+    Размер ищется двоичным поиском: шрифты и ширины слов берутся из кэшей
+    реестра, поэтому подбор стоит нескольких раскладок"""
+    font_size, padding, _, max_text_height = get_caption_metrics(img_height, style)
+    layout = _layout_at_size(text, img_width, font_size, padding, max_text_height, context, timer)
+    if not style.auto_fit or not layout['clipped'] or font_size <= MIN_FONT_SIZE:
+        return layout
+
+    # Крупнее заданного шрифт не делаем: подбор только уменьшает длинные подписи
+    low, high = MIN_FONT_SIZE, font_size - 1
+    best = None
+    while low <= high:
+        size = (low + high) // 2
+        candidate = _layout_at_size(text, img_width, size, padding, max_text_height, context, timer)
+        if candidate['clipped']:
+            high = size - 1
+        else:
+            best = candidate
+            low = size + 1
+    if best is None:
+        # Не помещается даже самым мелким шрифтом: остаток обрезается
+        best = _layout_at_size(text, img_width, MIN_FONT_SIZE, padding, max_text_height, context, timer)
+    return best
+
+def render_caption_strip(text, img_width, img_height, style, context, mode='RGB', timer=NULL_TIMER):
+    """Полоса с подписью для изображения заданного размера (из кэша, если уже отрисована)"""
+    font_size, padding, _, max_text_height = get_caption_metrics(img_height, style)
+
+    key = (text, img_width, font_size, padding, max_text_height,
+           style.text_color, style.background_color, context.fonts.font_path, mode, style.auto_fit)
+    cached = context.captions.get(key)
+    if cached is not None:
+        timer.mark('draw')
+        return cached
+
+    layout = layout_caption(text, img_width, img_height, style, context, timer)
+    measurer = layout['measurer']
+    wrapped_lines = layout['lines']
+    line_height = layout['line_height']
+    text_block_height = layout['height']
+
+    # Рисуем текст на отдельной полосе цвета фона
+    strip = Image.new(mode, (img_width, text_block_height),
+                      color=get_mode_color(style.background_color, mode))
+    draw = ImageDraw.Draw(strip)
+    y_position = padding
+
+    for line in wrapped_lines:
+        text_width = measurer.ink_width(line)
+        x_position = (img_width - text_width) / 2
+
+        measurer.draw(draw, (x_position, y_position), line, get_mode_color(style.text_color, mode))
+        y_position += line_height
+
+    # Сведения о подписи для отчета: строки, выбранный размер шрифта и обрезанные строки
+    caption = {'lines': len(wrapped_lines), 'font_size': layout['font_size'], 'truncated': layout['truncated']}
+    context.captions.put(key, strip, caption)
+    timer.mark('draw')
+    return strip, caption
+
+def compose_labeled_image(img, text, style, context, output_ext=None, timer=NULL_TIMER):
+    """Добавление подписи к открытому изображению. Возвращает (новое изображение,
+    сведения о подписи: lines, font_size, truncated); исходное не изменяется"""
+    mode = get_canvas_mode(img, output_ext, style)
+
+    # Получаем размеры изображения
+    img_width, img_height = img.size
+
+    # Конвертация выполняется, только если режим не подходит
+    img.load()
+    source = img if img.mode == mode else img.convert(mode)
+    timer.mark('decode')
+
+    # Текст измеряется по шрифту, без обращения к пикселям фотографии
+    strip, caption = render_caption_strip(text, img_width, img_height, style, context, mode, timer)
+    text_block_height = strip.height
+
+    # Создаем новое изображение с увеличенной высотой
+    new_img = Image.new(mode, (img_width, img_height + text_block_height),
+                        color=get_mode_color(style.background_color, mode))
+
+    # Вставляем оригинальное изображение и полосу с подписью в нужные позиции
+    if style.position == 'bottom':
+        new_img.paste(source, (0, 0))
+        new_img.paste(strip, (0, img_height))
+    else:
+        new_img.paste(strip, (0, 0))
+        new_img.paste(source, (0, text_block_height))
+    timer.mark('draw')
+
+    return new_img, caption
+
+def encode_image(img, output_ext, encode_profile=None, quality=None):
+    """Кодирование изображения в память в формате, соответствующем расширению"""
+    buffer = io.BytesIO()
+    image_format = EXTENSION_FORMATS[output_ext]
+    options = get_save_options(output_ext, encode_profile)
+    if quality is not None and image_format in ('JPEG', 'WEBP'):
+        options['quality'] = quality
+    img.save(buffer, format=image_format, **options)
+    return buffer
+
+def open_image(image):
+    """Открытие изображения: объект PIL возвращается как есть, байты и файлы открываются"""
+    if isinstance(image, Image.Image):
+        return image
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return Image.open(io.BytesIO(image))
+    return Image.open(image)
+
+def label_image(image, text, style=None, output_format=None):
+    """Возвращает новое изображение с подписью.
+
+    image - объект PIL, байты файла, путь или открытый файл;
+    style - LabelStyle (по умолчанию - оформление командной строки);
+    output_format - формат, в котором результат будет сохранен (влияет на
+    сохранение прозрачности), например 'jpeg'.
+    Шрифты и готовые подписи кэшируются на уровне процесса"""
+    style = style or LabelStyle()
+    context = get_render_context(style.font_path, style.bold, style.fallback_fonts)
+    output_ext = OUTPUT_FORMAT_EXTENSIONS[output_format] if output_format else None
+
+    img = open_image(image)
+    try:
+        new_img, _ = compose_labeled_image(img, text, style, context, output_ext)
+    finally:
+        # Закрываем только то, что открыли сами
+        if img is not image:
+            img.close()
+    return new_img
+
+def iter_labeled(items, style=None, output_format=None):
+    """Ленивая обработка пар (изображение, заголовок): результаты выдаются по одному"""
+    for image, text in items:
+        yield label_image(image, text, style, output_format)
+
+def label_file(filename, text, style, settings, timer=NULL_TIMER, data=None):
+    """Добавление подписи к одному файлу из входной папки (или к уже
+    прочитанным байтам data из архива) и сохранение результата.
+    Этапы decode, font_load, wrap, draw, encode и write отмечаются в timer"""
+    timer.start()
+    started = time.perf_counter()
+    key = None
+    if settings.get('dedup_store'):
+        # Исходник читается целиком ради хэша; повтор не декодируется вовсе
+        data, key, info = find_duplicate(filename, text, style, settings, data)
+        if info is not None:
+            timer.mark('write')
+            return info
+    source = os.path.join(settings['input'], filename)
+    if data is not None:
+        img, input_bytes = open_image_data(data, source), len(data)
+    else:
+        img, input_bytes = Image.open(source), os.path.getsize(source)
+    # Исходные пиксели освобождаются при закрытии файла, до кодирования результата
+    with img:
+        outputs, caption = render_outputs(img, filename, text, style, settings, timer)
+
+    info = write_outputs(outputs, caption, input_bytes, settings, timer)
+    if key is not None:
+        save_duplicate(key, info, settings, time.perf_counter() - started)
+    return info
+
+def get_output_filenames(filename, settings):
+    """Имена основного результата и вариантов"""
+    return [get_output_filename(filename, settings['output_format'])] + [
+        variant.get_output_filename(filename, settings['output_format'])
+        for variant in settings.get('variants') or []]
+
+def read_input(filename, settings, data=None):
+    """Чтение исходного файла блоками с вычислением хэша содержимого по ходу
+    чтения. Возвращает (байты, sha1 содержимого)"""
+    digest = hashlib.sha1()
+    if data is None:
+        chunks = []
+        with open(os.path.join(settings['input'], filename), 'rb') as f:
+            for chunk in iter(lambda: f.read(DEDUP_READ_CHUNK), b''):
+                digest.update(chunk)
+                chunks.append(chunk)
+        data = b''.join(chunks)
+    else:
+        digest.update(data)
+    return data, digest.hexdigest()
+
+def find_duplicate(filename, text, style, settings, data=None):
+    """Поиск готового результата для того же содержимого, подписи и оформления
+    в хранилище повторов. Возвращает (байты исходника, ключ, сведения о
+    результате или None, если его нужно отрисовать)"""
+    started = time.perf_counter()
+    data, content_hash = read_input(filename, settings, data)
+    store = DedupStore(settings['dedup_store'])
+    filenames = get_output_filenames(filename, settings)
+    key = store.make_key(content_hash, text, filenames, style, settings)
+    meta = store.lookup(key)
+    if meta is None:
+        return data, key, None
+    try:
+        files = store.restore(key, meta, filenames, settings)
+    except OSError:
+        # Хранилище недоступно - результат просто отрисовывается заново
+        return data, key, None
+    output_bytes = sum(meta['sizes'])
+    return data, key, {
+        'output_filename': filenames[0],
+        'variant_filenames': filenames[1:],
+        'files': files,
+        'line_count': meta['line_count'],
+        'font_size': meta['font_size'],
+        'truncated_lines': meta['truncated_lines'],
+        'input_bytes': len(data),
+        'output_bytes': output_bytes,
+        'pixels': meta['pixels'],
+        'deduplicated': True,
+        # Не закодировано и не записано заново; время - против первой отрисовки
+        'saved_bytes': output_bytes,
+        'saved_seconds': max(0.0, meta['seconds'] - (time.perf_counter() - started)),
+    }
+
+def save_duplicate(key, info, settings, seconds):
+    """Сохранение результата в хранилище повторов; ошибка хранилища не
+    делает ошибочной саму обработку"""
+    try:
+        DedupStore(settings['dedup_store']).publish(key, info, settings, seconds)
+    except OSError as e:
+        print(f"Не удалось сохранить результат в хранилище повторов: {e}")
+
+def get_resizable(img):
+    """Изображение в режиме, который можно уменьшать со сглаживанием"""
+    if img.mode in ('RGB', 'RGBA', 'L', 'LA'):
+        return img
+    # Палитру и прочие режимы нельзя уменьшать со сглаживанием
+    has_alpha = img.mode == 'PA' or 'transparency' in img.info
+    return img.convert('RGBA' if has_alpha else 'RGB')
+
+def apply_draft(img, max_size):
+    """Для JPEG: декодирование сразу в уменьшенном масштабе (1/2, 1/4 или 1/8)
+    через DCT, не меньше итогового размера. До загрузки пикселей; для
+    других форматов и уже декодированных изображений ничего не делает"""
+    target = get_capped_size(img.size, max_size)
+    if target != img.size:
+        img.draft(img.mode, target)
+
+def shrink_image(img, max_size, timer=NULL_TIMER):
+    """Уменьшение до ограничения размера: draft-декодирование JPEG,
+    целочисленное уменьшение Image.reduce и точная доводка LANCZOS"""
+    target = get_capped_size(img.size, max_size)
+    if target == img.size:
+        return img
+    apply_draft(img, max_size)
+    img.load()
+    timer.mark('decode')
+
+    source = get_resizable(img)
+    # reduce усредняет блоки пикселей и работает быстро; запас в 2 раза
+    # оставляем для качественного сглаживания на последнем шаге
+    factor = min(source.width // (target[0] * 2), source.height // (target[1] * 2))
+    if factor >= 2:
+        source = source.reduce(factor)
+    if source.size != target:
+        source = source.resize(target, Image.LANCZOS)
+    timer.mark('resize')
+    return source
+
+def render_outputs(img, filename, text, style, settings, timer=NULL_TIMER):
+    """Основной результат и варианты из одного декодированного изображения.
+    Подпись каждого варианта раскладывается заново в его разрешении, а не
+    уменьшается вместе с фотографией. Возвращает (список (изображение, имя
+    файла, качество), сведения о подписи основного результата)"""
+    context = get_render_context(style.font_path, style.bold, style.fallback_fonts)
+    output_filename = get_output_filename(filename, settings['output_format'])
+    output_ext = os.path.splitext(output_filename)[1].lower()
+    if settings.get('max_size'):
+        # Подпись раскладывается уже в итоговом размере
+        img = shrink_image(img, settings['max_size'], timer)
+    new_img, caption = compose_labeled_image(img, text, style, context, output_ext, timer)
+    outputs = [(new_img, output_filename, None)]
+
+    variants = settings.get('variants') or []
+    if variants:
+        source = get_resizable(img)
+        for variant in variants:
+            timer.start()
+            small = variant.fit(source)
+            timer.mark('resize')
+            variant_filename = variant.get_output_filename(filename, settings['output_format'])
+            variant_ext = os.path.splitext(variant_filename)[1].lower()
+            variant_img, _ = compose_labeled_image(small, text, style, context, variant_ext, timer)
+            outputs.append((variant_img, variant_filename, variant.quality))
+    return outputs, caption
+
+def write_outputs(outputs, caption, input_bytes, settings, timer=NULL_TIMER):
+    """Запись основного результата и вариантов; возвращает сведения для отчета"""
+    new_img, output_filename, _ = outputs[0]
+    output_bytes = 0
+    files = []
+    for img, name, quality in outputs:
+        if settings.get('output_archive'):
+            # В архив результаты пишет главный процесс: здесь только кодирование
+            output_ext = os.path.splitext(name)[1].lower()
+            data = encode_image(img, output_ext, settings['encode_profile'], quality).getvalue()
+            timer.mark('encode')
+            files.append((name, data))
+            output_bytes += len(data)
+        else:
+            output_bytes += write_output(img, name, settings, timer, quality)
+    return {
+        'output_filename': output_filename,
+        'variant_filenames': [name for _, name, _ in outputs[1:]],
+        'files': files,
+        'line_count': caption['lines'],
+        'font_size': caption['font_size'],
+        'truncated_lines': caption['truncated'],
+        'input_bytes': input_bytes,
+        'output_bytes': output_bytes,
+        'pixels': new_img.width * new_img.height,
+    }
+
+def open_image_data(data, path):
+    """Открытие изображения из байтов файла path. В ошибке нераспознанного
+    формата указывается путь, как при открытии по имени файла"""
+    try:
+        return Image.open(io.BytesIO(data))
+    except Image.UnidentifiedImageError:
+        raise Image.UnidentifiedImageError(f"cannot identify image file {path!r}") from None
+
+def read_source(filename, settings, data=None):
+    """Чтение исходного файла одним запросом и декодирование в память.
+    Возвращает (изображение, размер файла)"""
+    path = os.path.join(settings['input'], filename)
+    if data is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+    img = open_image_data(data, path)
+    if settings.get('max_size'):
+        # Уменьшение в потоке чтения: JPEG декодируется сразу в уменьшенном масштабе
+        img = shrink_image(img, settings['max_size'])
+    img.load()
+    return img, len(data)
+
+def write_output(new_img, output_filename, settings, timer=NULL_TIMER, quality=None):
+    """Кодирование результата и запись в выходную папку; возвращает размер файла"""
+    output_ext = os.path.splitext(output_filename)[1].lower()
+    # Кодируем в память, затем записываем одним вызовом
+    buffer = encode_image(new_img, output_ext, settings['encode_profile'], quality)
+    timer.mark('encode')
+
+    output_path = os.path.join(settings['output'], output_filename)
+    # При рекурсивной обработке повторяем структуру вложенных папок
+    if os.path.dirname(output_filename):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    # Прежний результат может быть жесткой ссылкой на файл хранилища повторов:
+    # перезапись на месте испортила бы и его
+    if os.path.lexists(output_path):
+        os.remove(output_path)
+    with open(output_path, 'wb') as f:
+        f.write(buffer.getbuffer())
+    timer.mark('write')
+    return buffer.tell()
+
+def _init_worker(font_path, bold, fallback_fonts=()):
+    # Ctrl+C обрабатывает главный процесс: рабочие дорабатывают текущие задачи
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Шрифт ищется один раз при запуске рабочего процесса
+    get_render_context(font_path, bold, fallback_fonts)
+
+def make_timer(settings):
+    # Без профилирования используется таймер-заглушка, чтобы не тратить время на замеры
+    return StageTimer() if settings['profile'] else NULL_TIMER
+
+def make_result(task, info, timer, error=None):
+    """Результат обработки одного изображения в общем для всех режимов виде"""
+    filename, text = task[0], task[1]
+    if info is None:
+        info = {'output_filename': None, 'variant_filenames': [], 'files': [], 'line_count': 0,
+                'font_size': 0, 'truncated_lines': 0,
+                'input_bytes': 0, 'output_bytes': 0, 'pixels': 0}
+    return dict(
+        info,
+        stages=getattr(timer, 'durations', None),
+        filename=filename,
+        title=text,
+        error=error,
+        pid=os.getpid(),
+        stats=get_render_stats(),
+        peak_rss=get_peak_rss(),
+    )
+
+def process_task(task):
+    """Обработка одного изображения с изоляцией ошибок"""
+    filename, text, style, settings = task[:4]
+    # Пятый элемент - байты изображения, если оно прочитано из архива
+    data = task[4] if len(task) > 4 else None
+    timer = make_timer(settings)
+    try:
+        return make_result(task, label_file(filename, text, style, settings, timer, data), timer)
+    except Exception as e:
+        return make_result(task, None, timer, str(e))
+
+class PipelineStopped(Exception):
+    """Конвейер остановлен, потому что потребитель перестал забирать результаты"""
+
+def _put(q, item, stop):
+    # Ожидание места в очереди прерывается остановкой конвейера
+    while True:
+        if stop.is_set():
+            raise PipelineStopped()
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+def iter_pipelined(tasks, settings, prefetch=2):
+    """Обработка в одном процессе конвейером из трех потоков: чтение и
+    декодирование следующих prefetch изображений, отрисовка подписи,
+    кодирование и запись готовых результатов. Очереди ограничены, поэтому
+    в памяти одновременно не больше ~2*prefetch изображений; Pillow
+    отпускает GIL при декодировании и кодировании, и ввод-вывод идет
+    параллельно с отрисовкой. Результаты возвращаются в исходном порядке"""
+    # Элементы очередей: (задача, таймер, данные этапа, ошибка); None - конец
+    decoded = queue.Queue(maxsize=prefetch)
+    rendered = queue.Queue(maxsize=prefetch)
+    results = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    failure = []
+
+    def reader():
+        try:
+            for task in tasks:
+                timer = make_timer(settings)
+                timer.start()
+                started = time.perf_counter()
+                try:
+                    data = task[4] if len(task) > 4 else None
+                    key = None
+                    if settings.get('dedup_store'):
+                        data, key, info = find_duplicate(task[0], task[1], task[2], settings, data)
+                        if info is not None:
+                            # Готовый результат проходит остальные этапы без изменений
+                            timer.mark('write')
+                            _put(decoded, (task, timer, info, None), stop)
+                            continue
+                    img, input_bytes = read_source(task[0], settings, data)
+                    timer.mark('decode')
+                    item = (task, timer, (img, input_bytes, key, started), None)
+                except Exception as e:
+                    item = (task, timer, None, str(e))
+                _put(decoded, item, stop)
+        except PipelineStopped:
+            return
+        except Exception as e:
+            # Ошибка самого источника задач (например, сканирования папки)
+            failure.append(e)
+        try:
+            _put(decoded, None, stop)
+        except PipelineStopped:
+            pass
+
+    def renderer():
+        try:
+            while True:
+                item = decoded.get()
+                if item is None:
+                    break
+                task, timer, data, error = item
+                if error is None and not isinstance(data, dict):
+                    filename, text, style = task[:3]
+                    img, input_bytes, key, started = data
+                    timer.start()
+                    try:
+                        outputs, caption = render_outputs(img, filename, text, style, settings, timer)
+                        data = (outputs, caption, input_bytes, key, started)
+                    except Exception as e:
+                        data, error = None, str(e)
+                    finally:
+                        img.close()
+                _put(rendered, (task, timer, data, error), stop)
+            _put(rendered, None, stop)
+        except PipelineStopped:
+            pass
+
+    def writer():
+        try:
+            while True:
+                item = rendered.get()
+                if item is None:
+                    break
+                task, timer, data, error = item
+                if error is not None:
+                    _put(results, make_result(task, None, timer, error), stop)
+                    continue
+                if isinstance(data, dict):
+                    # Результат взят из хранилища повторов
+                    _put(results, make_result(task, data, timer), stop)
+                    continue
+                outputs, caption, input_bytes, key, started = data
+                timer.start()
+                try:
+                    info = write_outputs(outputs, caption, input_bytes, settings, timer)
+                    if key is not None:
+                        save_duplicate(key, info, settings, time.perf_counter() - started)
+                    result = make_result(task, info, timer)
+                except Exception as e:
+                    result = make_result(task, None, timer, str(e))
+                _put(results, result, stop)
+            _put(results, None, stop)
+        except PipelineStopped:
+            pass
+
+    threads = [threading.Thread(target=target, name=f'labeler-{target.__name__}', daemon=True)
+               for target in (reader, renderer, writer)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            result = results.get()
+            if result is None:
+                break
+            yield result
+    finally:
+        stop.set()
+        # Освобождаем потоки, ожидающие чтения из очередей
+        for q in (decoded, rendered):
+            try:
+                q.put_nowait(None)
+            except queue.Full:
+                pass
+        for thread in threads:
+            thread.join()
+    if failure:
+        raise failure[0]
+
+def iter_processed(tasks, settings, workers=1, prefetch=0):
+    """Обработка изображений; результаты возвращаются в исходном порядке.
+    В одном процессе при prefetch > 0 используется конвейер из потоков"""
+    style = settings['style']
+    if workers <= 1 and prefetch > 0:
+        yield from iter_pipelined(tasks, settings, prefetch)
+        return
+    if workers <= 1:
+        for task in tasks:
+            yield process_task(task)
+        return
+
+    # Задачи отправляются скользящим окном: задания можно подавать по мере
+    # сканирования папки, а в памяти держится ограниченное число результатов
+    max_pending = workers * 4
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(style.font_path, style.bold, style.fallback_fonts)) as executor:
+        for task in tasks:
+            pending.append(executor.submit(process_task, task))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# Колонки отчета пробного запуска
+PLAN_FIELDS = ('filename', 'variant', 'output_filename', 'width', 'height', 'output_width', 'output_height',
+               'mode', 'font_size', 'lines', 'clipped', 'truncated_lines', 'extended_title', 'title', 'error')
+
+def plan_image(filename, text, style, settings, layouts=None, source=None):
+    """Строки плана для одного изображения: основной результат и по строке
+    на каждый вариант. Читается только заголовок файла, раскладка подписи
+    считается так же, как при обработке"""
+    output_filenames = get_output_filenames(filename, settings)
+    variants = [None] + list(settings.get('variants') or [])
+    if source is not None:
+        fp = source.open_member(filename)
+    else:
+        fp = os.path.join(settings['input'], filename)
+    # Image.open не декодирует пиксели, пока к ним не обратились
+    with Image.open(fp) as img:
+        size = get_capped_size(img.size, settings.get('max_size'))
+        outputs = []
+        for variant, output_filename in zip(variants, output_filenames):
+            output_ext = os.path.splitext(output_filename)[1].lower()
+            # Варианты уменьшаются из основного изображения
+            output_size = variant.get_size(size) if variant is not None else size
+            outputs.append((variant, output_filename, output_size, get_canvas_mode(img, output_ext, style)))
+
+    rows = []
+    for variant, output_filename, (width, height), mode in outputs:
+        # Одинаковые подписи на снимках одного размера раскладываются один раз
+        key = (text, width, height, style)
+        layout = layouts.get(key) if layouts is not None else None
+        if layout is None:
+            context = get_render_context(style.font_path, style.bold, style.fallback_fonts)
+            layout = layout_caption(text, width, height, style, context)
+            layout = {name: layout[name] for name in ('font_size', 'lines', 'height', 'clipped', 'truncated')}
+            if layouts is not None:
+                layouts[key] = layout
+
+        rows.append({
+            'filename': filename,
+            'variant': variant.suffix if variant is not None else '',
+            'output_filename': output_filename,
+            'width': width,
+            'height': height,
+            'output_width': width,
+            'output_height': height + layout['height'],
+            'mode': mode,
+            'font_size': layout['font_size'],
+            'lines': len(layout['lines']),
+            'clipped': layout['clipped'],
+            'truncated_lines': layout['truncated'],
+            'title': text,
+            'error': None,
+        })
+    return rows
+
+def save_plan_report(rows, path):
+    """Сохранение плана в CSV или JSON (по расширению файла)"""
+    if path.lower().endswith('.json'):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, ensure_ascii=False, indent=1)
+        return
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=PLAN_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def report_caption_manifest(caption_manifest, unmatched, limit=10):
+    """Изображения без подписи и подписи без изображений"""
+    unused = caption_manifest.unused()
+    if unmatched:
+        print(f"ВНИМАНИЕ: изображений без подписи в манифесте: {len(unmatched)} (пропущены)")
+        for filename in unmatched[:limit]:
+            print(f"  {filename}")
+        if len(unmatched) > limit:
+            print(f"  ... и еще {len(unmatched) - limit}")
+    if unused:
+        print(f"ВНИМАНИЕ: подписей без изображений: {len(unused)}")
+        for filename in unused[:limit]:
+            print(f"  {filename}")
+        if len(unused) > limit:
+            print(f"  ... и еще {len(unused) - limit}")
+
+def plan_batch(config, image_files, titles, settings, extended_count=0, caption_manifest=None,
+               source=None):
+    """Пробный запуск: размеры результатов и раскладка подписей без
+    декодирования пикселей и без записи файлов"""
+    style = settings['style']
+    started = time.perf_counter()
+    # Расширенные заголовки - последние extended_count в списке
+    first_extended = len(titles) - extended_count if titles is not None else None
+    layouts = {}
+    rows = []
+    unmatched = []
+    for i, filename in enumerate(image_files):
+        image_style = style
+        if caption_manifest is not None:
+            try:
+                entry = caption_manifest.get(filename)
+            except ValueError as e:
+                row = dict.fromkeys(PLAN_FIELDS)
+                row.update(filename=filename, title='', error=f"ошибка в манифесте подписей: {e}",
+                           extended_title=False)
+                rows.append(row)
+                continue
+            if entry is None:
+                unmatched.append(filename)
+                row = dict.fromkeys(PLAN_FIELDS)
+                row.update(filename=filename, title='', error="нет подписи в манифесте", extended_title=False)
+                rows.append(row)
+                continue
+            text, overrides = entry
+            if overrides:
+                image_style = style.replace(**overrides)
+        else:
+            text = titles[i] if titles is not None else get_title_from_filename(filename)
+        try:
+            image_rows = plan_image(filename, text, image_style, settings, layouts, source)
+        except Exception as e:
+            row = dict.fromkeys(PLAN_FIELDS)
+            row.update(filename=filename, title=text, error=str(e))
+            image_rows = [row]
+        for row in image_rows:
+            row['extended_title'] = first_extended is not None and extended_count > 0 and i >= first_extended
+        rows.extend(image_rows)
+    elapsed = time.perf_counter() - started
+
+    planned = [row for row in rows if row['error'] is None]
+    failed = [row for row in rows if row['error'] is not None]
+    # Переносы и обрезка - по основным результатам, по одному на изображение
+    multiline = [row for row in planned if row['lines'] > 1 and not row['variant']]
+    clipped = [row for row in planned if row['clipped'] and not row['variant']]
+    output_pixels = sum(row['output_width'] * row['output_height'] for row in planned)
+    variant_count = sum(1 for row in planned if row['variant'])
+
+    print("ПРОБНЫЙ ЗАПУСК: изображения не декодируются и не записываются")
+    print(f"Изображений: {len(rows) - variant_count}, прочитано заголовков за {elapsed:.2f} с")
+    if variant_count:
+        print(f"Файлов результатов: {len(planned)} (из них вариантов: {variant_count})")
+    for row in planned:
+        if row['variant'] and row['clipped']:
+            print(f"  Вариант {row['variant']} {row['filename']}: подпись обрезана ({row['lines']} стр.)")
+    sizes = {}
+    for row in planned:
+        size = (row['output_width'], row['output_height'])
+        sizes[size] = sizes.get(size, 0) + 1
+    print(f"Размеры результатов ({len(sizes)} различных), всего {output_pixels / 1e6:.1f} Мп:")
+    for (width, height), count in sorted(sizes.items(), key=lambda item: -item[1])[:10]:
+        print(f"  {width}x{height}: {count}")
+    if len(sizes) > 10:
+        print(f"  ... и еще {len(sizes) - 10}")
+    print(f"Подписей в несколько строк: {len(multiline)}")
+    print(f"Подписей, обрезанных по высоте ({int(MAX_TEXT_HEIGHT_RATIO * 100)}% изображения): {len(clipped)}")
+    for row in clipped[:10]:
+        print(f"  {row['filename']}: {row['lines']} стр., шрифт {row['font_size']}")
+    if len(clipped) > 10:
+        print(f"  ... и еще {len(clipped) - 10}")
+    if extended_count:
+        print(f"Заголовков, продублированных авторасширением: {extended_count}")
+    if caption_manifest is not None:
+        report_caption_manifest(caption_manifest, unmatched)
+        unmatched = set(unmatched)
+        failed = [row for row in failed if row['filename'] not in unmatched]
+    if failed:
+        print(f"Не удалось прочитать: {len(failed)}")
+        for row in failed[:10]:
+            print(f"  {row['filename']}: {row['error']}")
+
+    plan_file = getattr(config, 'plan_file', None)
+    if plan_file:
+        try:
+            save_plan_report(rows, plan_file)
+            print(f"План сохранен в '{plan_file}'")
+        except OSError as e:
+            print(f"Ошибка при сохранении плана: {e}")
+
+def parse_bool(value):
+    """Логическое значение из строки запроса или манифеста"""
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y', 'да')
+
+def parse_color(value):
+    """Цвет из строки: RRGGBB, R,G,B или название из списка предустановленных"""
+    value = value.strip().lower()
+    if value in COLORS:
+        return COLORS[value]
+    if ',' in value:
+        parts = [int(part) for part in value.split(',')]
+    else:
+        hex_value = value.lstrip('#')
+        if len(hex_value) != 6:
+            raise ValueError(f"Неверный цвет: {value}")
+        parts = [int(hex_value[i:i + 2], 16) for i in (0, 2, 4)]
+    if len(parts) != 3 or not all(0 <= part <= 255 for part in parts):
+        raise ValueError(f"Неверный цвет: {value}")
+    return tuple(parts)
+
+class LabelingService:
+    """Долгоживущий сервис подписей: ограниченный пул потоков отрисовки,
+    лимит очереди и статистика запросов. Pillow отпускает GIL при
+    декодировании и кодировании, поэтому потоки работают параллельно"""
+
+    def __init__(self, default_style, threads=1, queue_limit=64, encode_profile=None,
+                 latency_window=1000):
+        self.default_style = default_style
+        self.threads = threads
+        self.queue_limit = queue_limit
+        self.encode_profile = encode_profile
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='labeler')
+        self.started = time.time()
+        self.requests = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.pending = 0
+        self.active = 0
+        self.latencies = deque(maxlen=latency_window)
+        self._lock = threading.Lock()
+        # Шрифт ищется заранее, чтобы первый запрос не ждал загрузки
+        get_render_context(default_style.font_path, default_style.bold, default_style.fallback_fonts)
+
+    def make_style(self, params):
+        """Оформление запроса: параметры из строки запроса поверх оформления по умолчанию"""
+        changes = {}
+        if 'position' in params:
+            changes['position'] = params['position']
+        if 'bold' in params:
+            changes['bold'] = parse_bool(params['bold'])
+        if 'ratio' in params:
+            changes['text_size_ratio'] = float(params['ratio'])
+        if 'auto_fit' in params:
+            changes['auto_fit'] = parse_bool(params['auto_fit'])
+        if 'text_color' in params:
+            changes['text_color'] = parse_color(params['text_color'])
+        if 'background_color' in params:
+            changes['background_color'] = parse_color(params['background_color'])
+        return self.default_style.replace(**changes)
+
+    def _render(self, data, text, style, output_format, encode_profile):
+        with self._lock:
+            self.pending -= 1
+            self.active += 1
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                if output_format:
+                    output_ext = OUTPUT_FORMAT_EXTENSIONS[output_format]
+                else:
+                    # По умолчанию отвечаем в формате исходного изображения
+                    output_ext = OUTPUT_FORMAT_EXTENSIONS.get((img.format or '').lower(), '.png')
+                context = get_render_context(style.font_path, style.bold, style.fallback_fonts)
+                new_img, _ = compose_labeled_image(img, text, style, context, output_ext)
+            buffer = encode_image(new_img, output_ext, encode_profile)
+            return buffer.getvalue(), Image.MIME[EXTENSION_FORMATS[output_ext]]
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def reserve(self):
+        """Место в очереди для запроса, до чтения его тела: так в памяти
+        одновременно не больше queue_limit загруженных изображений.
+        False, если очередь переполнена"""
+        with self._lock:
+            self.requests += 1
+            if self.pending >= self.queue_limit:
+                self.rejected += 1
+                return False
+            self.pending += 1
+            return True
+
+    def release(self):
+        """Освобождение места, если запрос не дошел до отрисовки"""
+        with self._lock:
+            self.pending -= 1
+
+    def dispatch(self, data, text, style, output_format=None, encode_profile=None):
+        """Отправка изображения в пул на место, занятое reserve()"""
+        return self.executor.submit(self._render, data, text, style, output_format,
+                                    encode_profile or self.encode_profile)
+
+    def submit(self, data, text, style, output_format=None, encode_profile=None):
+        """Отправка изображения в пул; None, если очередь переполнена"""
+        if not self.reserve():
+            return None
+        return self.dispatch(data, text, style, output_format, encode_profile)
+
+    def record(self, seconds, ok):
+        with self._lock:
+            self.latencies.append(seconds)
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            stats = {
+                'uptime_seconds': round(time.time() - self.started, 1),
+                'threads': self.threads,
+                'queue_limit': self.queue_limit,
+                'requests': self.requests,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'queue_depth': self.pending,
+                'active': self.active,
+            }
+        stats['latency_ms'] = {
+            'p50': round(percentile(latencies, 0.5) * 1000, 2),
+            'p95': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99': round(percentile(latencies, 0.99) * 1000, 2),
+            'max': round((latencies[-1] if latencies else 0.0) * 1000, 2),
+        }
+        stats['caches'] = {name: {'hits': hits, 'misses': misses}
+                           for name, (hits, misses) in get_render_stats().items()}
+        return stats
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+class LabelRequestHandler(BaseHTTPRequestHandler):
+    """HTTP-обработчик: POST /label - подпись к изображению, GET /stats - статистика.
+
+    Тело POST /label - байты изображения, параметры - в строке запроса:
+    title, position (top/bottom), bold, ratio, text_color, background_color,
+    format (jpeg/png/webp/tiff/bmp) и encode_profile (fast/balanced/small)"""
+
+    server_version = 'ImageTextAdder'
+    # Максимальный размер загружаемого изображения
+    max_upload_bytes = 200 * 1024 * 1024
+
+    # Сколько ждать, пока клиент дошлет тело отклоненного запроса
+    reject_drain_timeout = 2.0
+
+    def _send(self, status, body, content_type='application/json; charset=utf-8', close=False):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        elif isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if close:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reject(self, status, body, length):
+        """Ответ без чтения тела запроса и закрытие соединения. Непрочитанное
+        тело дочитывается и отбрасывается блоками (не накапливается в памяти):
+        если закрыть сокет с данными в буфере, клиент получит сброс соединения
+        вместо ответа"""
+        self._send(status, body, close=True)
+        try:
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_WR)
+            self.connection.settimeout(self.reject_drain_timeout)
+            while length > 0:
+                chunk = self.rfile.read1(min(length, 64 * 1024))
+                if not chunk:
+                    break
+                length -= len(chunk)
+        except OSError:
+            pass
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/stats':
+            self._send(200, self.server.service.stats())
+        elif path == '/health':
+            self._send(200, {'status': 'ok'})
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        started = time.perf_counter()
+        url = urlsplit(self.path)
+        if url.path != '/label':
+            self._send(404, {'error': 'not found'})
+            return
+
+        service = self.server.service
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0:
+            self._send(400, {'error': 'empty body'})
+            return
+        if length > self.max_upload_bytes:
+            self._reject(413, {'error': 'image too large'}, length)
+            return
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            style = service.make_style(params)
+            output_format = params.get('format')
+            if output_format and output_format not in OUTPUT_FORMAT_EXTENSIONS:
+                raise ValueError(f"Неизвестный формат: {output_format}")
+            encode_profile = params.get('encode_profile')
+            if encode_profile and encode_profile not in ENCODE_PROFILES:
+                raise ValueError(f"Неизвестный профиль кодирования: {encode_profile}")
+        except ValueError as e:
+            self._reject(400, {'error': str(e)}, length)
+            return
+
+        # Очередь проверяется до чтения тела: переполненный сервис не загружает изображение
+        if not service.reserve():
+            self._reject(503, {'error': 'queue is full'}, length)
+            return
+        try:
+            data = self.rfile.read(length)
+        except OSError:
+            service.release()
+            raise
+        if len(data) < length:
+            service.release()
+            self._send(400, {'error': 'incomplete body'}, close=True)
+            return
+        future = service.dispatch(data, params.get('title', ''), style, output_format, encode_profile)
+
+        try:
+            body, content_type = future.result()
+        except Exception as e:
+            service.record(time.perf_counter() - started, ok=False)
+            self._send(422, {'error': str(e)})
+            return
+        service.record(time.perf_counter() - started, ok=True)
+        self._send(200, body, content_type)
+
+    def log_message(self, format, *args):
+        # Журнал каждого запроса не выводим: при нагрузке он сам становится узким местом
+        pass
+
+class LabelHTTPServer(ThreadingHTTPServer):
+    """HTTP-сервер сервиса подписей. Очередь входящих соединений больше
+    стандартной (5): при всплеске нагрузки клиенты получают быстрый ответ
+    503, а не сброс соединения ядром"""
+    daemon_threads = True
+    request_queue_size = 1024
+
+def run_server(host, port, service):
+    """Запуск HTTP-сервиса до нажатия Ctrl+C"""
+    server = LabelHTTPServer((host, port), LabelRequestHandler)
+    server.service = service
+    print(f"Сервис подписей запущен: http://{host}:{server.server_address[1]}")
+    print("  POST /label?title=...  - подпись к изображению из тела запроса")
+    print("  GET  /stats            - статистика запросов и задержек")
+    print(f"Потоков отрисовки: {service.threads}, лимит очереди: {service.queue_limit}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nОстановка сервиса...")
+    finally:
+        server.server_close()
+        service.shutdown()
+
+class InotifyWatcher:
+    """Уведомления inotify (Linux) о файлах, созданных, дописанных или
+    перемещенных в папку. Вызывается через ctypes, без сторонних модулей"""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, folder):
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch")
+
+    def wait(self, timeout):
+        """Имена файлов с событиями за время ожидания; None - нужен полный пересмотр папки"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        names = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """Запасной вариант без inotify: папка пересматривается целиком по таймеру"""
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return None
+
+    def close(self):
+        pass
+
+def create_watcher(folder, recursive=False):
+    """inotify на Linux; опрос папки на других системах и для вложенных папок"""
+    if sys.platform.startswith('linux') and not recursive:
+        try:
+            return InotifyWatcher(folder)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher()
+
+def describe_caption(result, auto_fit=False):
+    """Строки подписи для отчета: количество, подобранный шрифт и обрезка"""
+    text = f"{result['line_count']} стр."
+    if auto_fit:
+        text += f", шрифт {result['font_size']}"
+    if result['truncated_lines']:
+        text += f", обрезано {result['truncated_lines']} стр."
+    return text
+
+def is_output_fresh(settings, filename, stat):
+    """Результат и все его варианты уже есть и новее исходника
+    (используется при запуске наблюдения)"""
+    for output_filename in get_output_filenames(filename, settings):
+        output_path = os.path.join(settings['output'], output_filename)
+        try:
+            if os.stat(output_path).st_mtime_ns < stat.st_mtime_ns:
+                return False
+        except OSError:
+            return False
+    return True
+
+def watch_folder(config, settle=1.0):
+    """Наблюдение за входной папкой: каждое новое изображение подписывается,
+    как только файл перестает меняться settle секунд. Шрифты и рабочие
+    процессы остаются загруженными между поступлениями файлов"""
+    settings = get_render_settings(config)
+    style = settings['style']
+    recursive = getattr(config, 'recursive', False)
+    exclude_dirs = {os.path.realpath(config.output)}
+    if os.path.realpath(config.input) in exclude_dirs:
+        # Иначе каждый результат снова попадал бы на обработку как новый файл
+        print("Ошибка: в режиме наблюдения папка результатов должна отличаться от входной!")
+        return
+    workers = getattr(config, 'workers', 1)
+    if workers == 0:
+        workers = os.cpu_count() or 1
+
+    caption_manifest = None
+    if config.title_source == 'manifest':
+        try:
+            caption_manifest = CaptionManifest(config.captions)
+        except (OSError, ValueError) as e:
+            print(f"Ошибка при чтении манифеста подписей '{config.captions}': {e}")
+            return
+    elif config.title_source == 'file':
+        # Новые файлы приходят в произвольном порядке, сопоставить их со строками titles.txt нельзя
+        print("В режиме наблюдения заголовки берутся из имен файлов")
+
+    # Шрифт загружается заранее, чтобы первый файл не ждал его
+    get_render_context(style.font_path, style.bold, style.fallback_fonts)
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                       initargs=(style.font_path, style.bold, style.fallback_fonts))
+    watcher = create_watcher(config.input, recursive)
+    tick = max(0.1, min(0.5, settle / 2))
+
+    print(f"Наблюдение за папкой '{config.input}' "
+          f"({'inotify' if isinstance(watcher, InotifyWatcher) else 'опрос папки'}), "
+          f"файл считается записанным через {settle:g} с без изменений")
+    print("Для остановки нажмите Ctrl+C")
+    print("-" * 50)
+
+    # Файлы, ожидающие окончания записи: путь -> ((размер, mtime), время последнего изменения)
+    pending = {}
+    # Сигнатуры уже обработанных (или неудачных) файлов: повторно берутся только после изменения
+    done = {}
+    in_flight = deque()
+    completions = deque()
+    processed_count = failed_count = 0
+
+    def scan():
+        for rel_path, entry in scan_image_entries(config.input, recursive, exclude_dirs):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if done.get(rel_path) != signature and rel_path not in pending:
+                pending[rel_path] = (signature, time.monotonic())
+
+    def report(result):
+        nonlocal processed_count, failed_count
+        now = time.monotonic()
+        completions.append(now)
+        # Скользящее окно в одну минуту
+        while completions and now - completions[0] > 60:
+            completions.popleft()
+        if result['error'] is not None:
+            failed_count += 1
+            print(f"Ошибка при обработке {result['filename']}: {result['error']}")
+            return
+        processed_count += 1
+        print(f"Обработано: {result['filename']} -> {result['output_filename']} "
+              f"({describe_caption(result, style.auto_fit)}) [{len(completions)} изобр./мин]")
+
+    # Уже подписанные до запуска файлы не трогаем
+    for rel_path, entry in scan_image_entries(config.input, recursive, exclude_dirs):
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        if is_output_fresh(settings, rel_path, stat):
+            done[rel_path] = (stat.st_size, stat.st_mtime_ns)
+    scan()
+
+    try:
+        while True:
+            changed = watcher.wait(tick)
+            if changed is None:
+                scan()
+            else:
+                for name in changed:
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        pending.setdefault(name, (None, time.monotonic()))
+
+            now = time.monotonic()
+            for rel_path, (signature, since) in list(pending.items()):
+                try:
+                    stat = os.stat(os.path.join(config.input, rel_path))
+                except OSError:
+                    # Файл удален или переименован до окончания записи
+                    del pending[rel_path]
+                    continue
+                current = (stat.st_size, stat.st_mtime_ns)
+                if current != signature or stat.st_size == 0:
+                    pending[rel_path] = (current, now)
+                    continue
+                if now - since < settle:
+                    continue
+
+                del pending[rel_path]
+                done[rel_path] = current
+                if caption_manifest is not None:
+                    try:
+                        entry = caption_manifest.get(rel_path)
+                    except ValueError as e:
+                        print(f"Ошибка в манифесте подписей для {rel_path}: {e}")
+                        continue
+                    if entry is None:
+                        print(f"Нет подписи в манифесте: {rel_path} (пропущено)")
+                        continue
+                    text, overrides = entry
+                    task_style = style.replace(**overrides) if overrides else style
+                else:
+                    text, task_style = get_title_from_filename(rel_path), style
+                task = (rel_path, text, task_style, settings)
+                if executor is None:
+                    report(process_task(task))
+                else:
+                    in_flight.append(executor.submit(process_task, task))
+
+            while in_flight and in_flight[0].done():
+                report(in_flight.popleft().result())
+    except KeyboardInterrupt:
+        print("\nОстановка наблюдения...")
+    finally:
+        watcher.close()
+        if executor is not None:
+            for future in in_flight:
+                try:
+                    report(future.result())
+                except Exception:
+                    # Рабочие процессы тоже получают Ctrl+C
+                    pass
+            executor.shutdown()
+        if caption_manifest is not None:
+            caption_manifest.close()
+
+    print("-" * 50)
+    print(f"Наблюдение завершено. Обработано: {processed_count}, ошибок: {failed_count}")
+
+def interactive_mode():
+    """Интерактивный режим настройки параметров"""
+    print("=" * 60)
+    print("        РЕЖИМ НАСТРОЙКИ ПАРАМЕТРОВ")
+    print("=" * 60)
+    
+    # Создаем объект для хранения настроек
+    class Config:
+        pass
+    
+    config = Config()
+    
+    # Настройка путей к файлам
+    print("\nШАГ 1: Настройка путей к файлам")
+    config.input = get_input_path("Папка с изображениями:", "photos", "folder")
+    config.output = get_input_path("Папка для результатов:", "output", "folder")
+    
+    # Настройка источника заголовков
+    config.title_source = select_title_source("Источник заголовков для изображений:")
+    
+    if config.title_source == 'file':
+        config.titles = get_input_path("Файл с заголовками:", "titles.txt", "file")
+        # Проверяем, что файл с заголовками существует
+        if config.titles and not os.path.exists(config.titles):
+            print("Файл с заголовками не существует. Создайте его или укажите правильный путь.")
+            return None
+    else:
+        config.titles = None
+
+    if config.title_source == 'manifest':
+        config.captions = get_input_path("Файл манифеста подписей:", "captions.csv", "file")
+        if not config.captions or not os.path.exists(config.captions):
+            print("Файл манифеста подписей не существует. Создайте его или укажите правильный путь.")
+            return None
+    
+    # Настройка метода сортировки
+    config.sort_by = select_sort_method("Сортировка изображений")
+    
+    # Настройка шрифта
+    custom_font_path, config.font_name = select_font()
+    
+    # Настройка размера текста
+    text_size_ratio = select_percentage(
+        "Размер текста относительно высоты изображения:",
+        default=3
+    )
+    
+    # Подбор размера для длинных подписей
+    auto_fit = select_yes_no("Уменьшать шрифт длинных подписей, чтобы они помещались целиком?", default=False)
+    
+    # Настройка цвета текста
+    text_color = select_color(
+        "Цвет текста:",
+        default_color=(0, 0, 0),
+        color_type="текста"
+    )
+    
+    # Настройка жирности текста
+    bold = select_yes_no("Жирный текст?", default=False)
+    
+    # Настройка позиции текста
+    position = select_position("Позиция текста:")
+    
+    # Настройка цвета фона
+    background_color = select_color(
+        "Цвет фона текстовой области:",
+        default_color=(255, 255, 255),
+        color_type="фона"
+    )
+
+    config.style = LabelStyle(
+        text_size_ratio=text_size_ratio,
+        text_color=text_color,
+        background_color=background_color,
+        position=position,
+        font_path=custom_font_path,
+        bold=bold,
+        auto_fit=auto_fit,
+    )
+    
+    # Настройка автоматического расширения (только для файловых заголовков)
     if config.title_source == 'file':
+        config.auto_extend = select_yes_no("Автоматически расширять последний заголовок?", default=False)
+    else:
+        config.auto_extend = False
+    
+    return config
+
+def main():
+    # Получаем аргументы командной строки
+    args = parse_arguments()
+
+    if args.merge_shards:
+        merge_shards(args.merge_shards, args.merge_report)
+        return
+
+    if args.shard:
+        try:
+            args.shard = ShardSpec.parse(args.shard, args.shard_by)
+        except ValueError as e:
+            print(f"Ошибка: {e}")
+            return
+
+    if args.variants:
+        try:
+            args.variants = [OutputVariant.parse(spec) for spec in args.variants]
+        except ValueError as e:
+            print(f"Ошибка: {e}")
+            return
+        suffixes = [variant.suffix for variant in args.variants]
+        if len(set(suffixes)) != len(suffixes):
+            print("Ошибка: суффиксы вариантов должны различаться")
+            return
+
+    if args.serve:
+        threads = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+        service = LabelingService(LabelStyle(position=args.position, bold=args.bold, auto_fit=args.auto_fit,
+                                             fallback_fonts=args.fallback_fonts or ()),
+                                  threads=threads, queue_limit=args.queue_limit,
+                                  encode_profile=args.encode_profile)
+        run_server(args.host, args.port, service)
+        return
+
+    # Если запрошен интерактивный режим, запускаем его
+    if args.interactive or len(sys.argv) == 1:
+        config = interactive_mode()
+        
+        if config is None:
+            print("Настройка отменена.")
+            return
+        
+        # Показываем сводку настроек
+        print("\n" + "=" * 60)
+        print("        СВОДКА НАСТРОЕК")
+        print("=" * 60)
+        print(f"Папка с изображениями: {config.input}")
+        print(f"Папка для результатов: {config.output}")
+        print(f"Источник заголовков: {TITLE_SOURCE_NAMES[config.title_source]}")
+        if config.title_source == 'file':
+            print(f"Файл с заголовками: {config.titles}")
+        elif config.title_source == 'manifest':
+            print(f"Манифест подписей: {config.captions}")
+        print(f"Сортировка: {SORT_METHOD_NAMES[config.sort_by]}")
+        style = config.style
+        print(f"Шрифт: {'Стандартный Times' if style.font_path is None else 'Пользовательский: ' + config.font_name}")
+        print(f"Размер текста: {style.text_size_ratio * 100}% от высоты изображения")
+        print(f"Автоподбор размера: {'Да' if style.auto_fit else 'Нет'}")
+        print(f"Цвет текста: {style.text_color}")
+        print(f"Жирный текст: {'Да' if style.bold else 'Нет'}")
+        print(f"Позиция текста: {'верх' if style.position == 'top' else 'низ'}")
+        print(f"Цвет фона: {style.background_color}")
+        if config.title_source == 'file':
+            print(f"Авторасширение: {'Да' if config.auto_extend else 'Нет'}")
+        print("=" * 60)
+        
+        if not ask_confirmation("Начать обработку с этими настройками?"):
+            print("Обработка отменена.")
+            return
+    else:
+        # Используем настройки из аргументов командной строки
+        config = args
+        # Размер (3%), цвета (черный на белом) и шрифт (Times) - по умолчанию
+        config.style = LabelStyle(position=args.position, bold=args.bold, auto_fit=args.auto_fit,
+                                  fallback_fonts=args.fallback_fonts or ())
+        config.font_name = "times.ttf"
+        if args.captions:
+            config.title_source = 'manifest'
+        else:
+            config.title_source = 'filename' if args.use_filename else 'file'
+
+    if getattr(config, 'watch', False):
+        if is_archive_path(config.input) or is_archive_path(config.output):
+            print("Ошибка: в режиме наблюдения нельзя использовать архивы!")
+        elif not os.path.exists(config.input):
+            print(f"Ошибка: Папка '{config.input}' не существует!")
+        else:
+            os.makedirs(config.output, exist_ok=True)
+            watch_folder(config, config.settle)
+    else:
+        process_batch(config)
+
+    # Для Windows: оставляем консоль открытой
+    if os.name == 'nt':
+        input("Нажмите Enter для выхода...")
+
+def process_batch(config):
+    """Пакетная обработка папки с изображениями по готовым настройкам"""
+    # Проверяем существование необходимых папок
+    if not os.path.exists(config.input):
+        print(f"Ошибка: Папка '{config.input}' не существует!")
+        input("Нажмите Enter для выхода...")
+        return
+
+    dry_run = getattr(config, 'dry_run', False)
+    archive_input = is_archive_path(config.input)
+    archive_output = is_archive_path(config.output)
+    if config.sort_by == 'archive' and not archive_input:
+        # У папки нет "порядка архива" - молча сортировать иначе нельзя
+        print("Ошибка: сортировка archive доступна только для входного архива zip или tar!")
+        input("Нажмите Enter для выхода...")
+        return
+    # Создаем выходную папку (при пробном запуске ничего не записывается)
+    if not dry_run:
+        if archive_output:
+            os.makedirs(os.path.dirname(os.path.abspath(config.output)), exist_ok=True)
+        else:
+            os.makedirs(config.output, exist_ok=True)
+
+    recursive = getattr(config, 'recursive', False)
+    # Выходная папка может лежать внутри входной - ее не сканируем
+    exclude_dirs = {os.path.realpath(config.output)}
+    if getattr(config, 'dedup_store', None):
+        exclude_dirs.add(os.path.realpath(config.dedup_store))
+
+    # Без сортировки и с заголовками из имен файлов список не нужен целиком:
+    # обработка начинается, не дожидаясь окончания сканирования папки
+    shard = getattr(config, 'shard', None)
+    # Подписи из манифеста тоже ищутся по имени файла, без выравнивания по порядку.
+    # Для шардов-диапазонов нужна длина полного списка
+    streaming = (config.sort_by in ('none', 'archive') and config.title_source in ('filename', 'manifest')
+                 and (shard is None or shard.method == 'hash'))
+
+    source = None
+    archive_order = None
+    if archive_input:
+        try:
+            source = ArchiveSource(config.input)
+            if streaming:
+                # Имена читаются тем же проходом, что и сами изображения
+                image_files = source.iter_names()
+            else:
+                image_files, archive_order = get_archive_members_sorted(source, config.sort_by)
+        except (OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+            print(f"Ошибка при чтении архива '{config.input}': {e}")
+            input("Нажмите Enter для выхода...")
+            return
+        titles = None
+        if not streaming and not image_files:
+            print(f"В архиве '{config.input}' не найдено изображений!")
+            input("Нажмите Enter для выхода...")
+            return
+    elif streaming:
+        image_files = iter_image_files(config.input, recursive, exclude_dirs)
+        titles = None
+    else:
+        # Получаем список изображений с сортировкой
+        image_files = get_image_files_sorted(config.input, config.sort_by, recursive, exclude_dirs)
+
+        if not image_files:
+            print(f"В папке '{config.input}' не найдено изображений!")
+            input("Нажмите Enter для выхода...")
+            return
+
+    # Получаем заголовки в зависимости от выбранного источника
+    extended_count = 0
+    caption_manifest = None
+    if config.title_source == 'manifest':
+        try:
+            caption_manifest = CaptionManifest(config.captions)
+        except (OSError, ValueError) as e:
+            print(f"Ошибка при чтении манифеста подписей '{config.captions}': {e}")
+            input("Нажмите Enter для выхода...")
+            return
+        titles = None
+        print(f"Загружено подписей из манифеста: {len(caption_manifest)}"
+              + (" (потоковый режим, в памяти только индекс)" if caption_manifest.streaming else ""))
+        if caption_manifest.duplicates:
+            print(f"ВНИМАНИЕ: повторяющихся имен файлов в манифесте: {caption_manifest.duplicates} "
+                  f"(используется последняя запись)")
+    elif streaming:
+        print("Заголовки создаются из имен файлов по мере обнаружения изображений")
+    elif config.title_source == 'file':
         # Загружаем названия из файла
         if not os.path.exists(config.titles):
             print(f"Ошибка: Файл '{config.titles}' не существует!")
@@ -499,7 +3750,9 @@ def main():
             print(f"'{last_title}'")
             print()
             
-            if not config.auto_extend:
+            if dry_run:
+                print("Пробный запуск: заголовки расширяются без подтверждения")
+            elif not config.auto_extend:
                 if not ask_confirmation("Продолжить с этими настройками?"):
                     print("Обработка отменена пользователем.")
                     return
@@ -508,6 +3761,7 @@ def main():
             
             # Расширяем список заголовков, повторяя последний заголовок
             titles.extend([last_title] * missing_count)
+            extended_count = missing_count
             print(f"Список заголовков расширен до {len(titles)} записей")
             print("-" * 50)
     else:
@@ -515,183 +3769,293 @@ def main():
         titles = get_titles_from_filenames(image_files)
         print(f"Создано {len(titles)} заголовков из имен файлов")
 
-    print(f"\nНайдено {len(image_files)} изображений")
-    print(f"Сортировка: {'по имени' if config.sort_by == 'name' else 'по дате создания'}")
-    print(f"Источник заголовков: {'из файла' if config.title_source == 'file' else 'из имени файла'}")
+    if not streaming:
+        print(f"\nНайдено {len(image_files)} изображений")
+    print(f"Сортировка: {SORT_METHOD_NAMES[config.sort_by]}")
+    print(f"Источник заголовков: {TITLE_SOURCE_NAMES[config.title_source]}")
     print(f"Используемый шрифт: {config.font_name}")
+    if config.style.fallback_fonts:
+        print(f"Резервные шрифты: {', '.join(config.style.fallback_fonts)}")
+    print(f"Профиль кодирования: {ENCODE_PROFILE_NAMES[getattr(config, 'encode_profile', None)]}")
+    if getattr(config, 'output_format', None):
+        print(f"Формат результатов: {config.output_format}")
+    max_size = get_max_size(config)
+    if max_size:
+        print(f"Ограничение размера: {max_size[0] or '-'} x {max_size[1] or '-'} px")
+    if getattr(config, 'variants', None):
+        print(f"Варианты: {', '.join(variant.describe() for variant in config.variants)}")
+    if shard is not None:
+        print(f"Шард: {shard} ({SHARD_METHOD_NAMES[shard.method]})")
     print("-" * 50)
 
+    if archive_order is not None and archive_order != image_files:
+        # Заголовки уже сопоставлены в порядке сортировки, а читается архив
+        # по порядку: переставляем пары (файл, заголовок) в порядок архива
+        positions = {filename: i for i, filename in enumerate(image_files)}
+        if titles is not None:
+            titles = [titles[positions[filename]] for filename in archive_order]
+        image_files = archive_order
+
+    total_images = None if streaming else len(image_files)
+    if shard is not None and dry_run:
+        # Заголовки выбираются по позиции в полном списке, затем список сужается до шарда
+        selected = [(i, filename) for i, filename in enumerate(image_files)
+                    if shard.contains(i, filename, total_images)]
+        image_files = [filename for _, filename in selected]
+        if titles is not None:
+            first_extended = len(titles) - extended_count
+            extended_count = sum(1 for i, _ in selected if i >= first_extended)
+            titles = [titles[i] for i, _ in selected]
+
+    settings = get_render_settings(config)
+    if dry_run:
+        plan_batch(config, image_files, titles, settings, extended_count, caption_manifest, source)
+        if caption_manifest is not None:
+            caption_manifest.close()
+        if source is not None:
+            source.close()
+        return
+
+    workers = getattr(config, 'workers', 1)
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    prefetch = getattr(config, 'prefetch', 0)
+    if workers > 1:
+        print(f"Рабочих процессов: {workers}")
+    elif prefetch > 0:
+        print(f"Конвейер: чтение и запись с опережением на {prefetch} изобр.")
+
+    temp_store = None
+    if getattr(config, 'dedup', False) and settings['dedup_store'] is None:
+        # Для архива-результата повторы ищутся только в пределах запуска
+        temp_store = settings['dedup_store'] = tempfile.mkdtemp(prefix='labeler_dedup_')
+    if temp_store is not None:
+        print("Поиск повторов по содержимому: в пределах запуска")
+    elif settings['dedup_store']:
+        print(f"Поиск повторов по содержимому: хранилище '{settings['dedup_store']}'")
+
     # Обрабатываем изображения
     processed_count = 0
-    
-    for i, filename in enumerate(image_files):
+    skipped_count = 0
+    total_count = 0
+    output_bytes = 0
+    dedup_count = 0
+    dedup_bytes = 0
+    dedup_seconds = 0.0
+    cache_stats = {}
+    peak_rss = {}
+    task_indices = deque()
+    unmatched = []
+    failed = []
+    started = time.perf_counter()
+
+    incremental = getattr(config, 'incremental', False)
+    if incremental and (archive_input or archive_output):
+        print("Инкрементальная обработка для архивов не поддерживается: обрабатываются все изображения")
+        incremental = False
+    sink = None
+    if archive_output:
         try:
-            # Открываем и конвертируем изображение
-            img_path = os.path.join(config.input, filename)
-            img = Image.open(img_path).convert('RGB')
-            
-            # Получаем размеры изображения
-            img_width, img_height = img.size
-            
-            # Вычисляем адаптивные параметры на основе размера изображения
-            base_font_size = int(img_height * config.text_size_ratio)
-            font_size = max(MIN_FONT_SIZE, min(MAX_FONT_SIZE, base_font_size))
-            
-            padding = int(img_height * PADDING_RATIO)
-            line_spacing = int(font_size * LINE_SPACING_RATIO)
-            max_text_height = int(img_height * MAX_TEXT_HEIGHT_RATIO)
-            
-            # Загружаем шрифт
-            font = None
-            
-            # Если указан пользовательский шрифт
-            if config.custom_font_path:
+            sink = ArchiveSink(config.output)
+        except (OSError, tarfile.TarError) as e:
+            print(f"Ошибка при создании архива '{config.output}': {e}")
+            return
+    if incremental:
+        settings_hash = get_settings_hash(settings)
+        # У каждого шарда свой манифест: шарды могут писать в одну папку
+        manifest_filename = MANIFEST_FILENAME
+        if shard is not None:
+            manifest_filename = MANIFEST_FILENAME.replace('.json', f'_{shard.suffix()}.json')
+        old_entries = load_manifest(config.output, manifest_filename)
+        manifest_entries = {}
+        signatures = {}
+        # Хэши оформления изображений с переопределениями из манифеста подписей
+        style_hashes = {}
+
+    def iter_tasks():
+        nonlocal total_count, skipped_count
+        for i, filename in enumerate(image_files):
+            if shard is not None and not shard.contains(i, filename, total_images):
+                continue
+            total_count += 1
+            style = settings['style']
+            if caption_manifest is not None:
                 try:
-                    font = ImageFont.truetype(config.custom_font_path, font_size)
-                except Exception as e:
-                    print(f"Ошибка загрузки пользовательского шрифта: {e}")
-                    print("Используется стандартный шрифт")
-                    config.custom_font_path = None
-            
-            # Если пользовательский шрифт не загружен, используем стандартные пути
-            if font is None:
-                font_paths = [
-                    "times.ttf",
-                    "times new roman.ttf", 
-                    "Times New Roman.ttf",
-                    "Times.ttf",
-                    get_resource_path("times.ttf")
-                ]
-                
-                # Если нужен жирный шрифт, пробуем сначала жирные версии
-                if config.bold:
-                    bold_paths = [
-                        "timesbd.ttf", "timesb.ttf", "TIMESBD.TTF",
-                        "times new roman bold.ttf", "Times New Roman Bold.ttf",
-                        get_resource_path("timesbd.ttf")
-                    ]
-                    font_paths = bold_paths + font_paths
-                
-                for font_path in font_paths:
-                    try:
-                        if os.path.exists(font_path):
-                            font = ImageFont.truetype(font_path, font_size)
-                            break
-                    except:
-                        continue
-            
-            # Если шрифт все еще не найден, используем стандартный
-            if font is None:
-                print(f"Шрифт не найден, используется стандартный шрифт")
-                font = ImageFont.load_default()
-            
-            # Создаем временный объект для рисования для расчета размеров текста
-            temp_draw = ImageDraw.Draw(img)
-            
-            # Подготавливаем текст с переносами
-            text = titles[i]
-            
-            # Определяем максимальную ширину для текста (с отступами)
-            max_text_width = img_width - 2 * padding
-            
-            # Разбиваем текст на строки с учетом переноса
-            avg_char_width = font_size * 0.6
-            approx_chars_per_line = max(10, int(max_text_width / avg_char_width))
-            
-            wrapper = textwrap.TextWrapper(width=approx_chars_per_line)
-            wrapped_lines = wrapper.wrap(text)
-            
-            # Если текст не помещается по ширине, разбиваем по символам
-            if not wrapped_lines:
-                def split_text_by_width(text, font, max_width):
-                    lines = []
-                    current_line = ""
-                    
-                    for char in text:
-                        test_line = current_line + char
-                        bbox = temp_draw.textbbox((0, 0), test_line, font=font)
-                        test_width = bbox[2] - bbox[0]
-                        
-                        if test_width <= max_width:
-                            current_line = test_line
-                        else:
-                            if current_line:
-                                lines.append(current_line)
-                            current_line = char
-                    
-                    if current_line:
-                        lines.append(current_line)
-                    
-                    return lines
-                
-                wrapped_lines = split_text_by_width(text, font, max_text_width)
-            
-            # Вычисляем высоту текстового блока
-            bbox = temp_draw.textbbox((0, 0), "Test", font=font)
-            line_height = bbox[3] - bbox[1] + line_spacing
-            text_block_height = len(wrapped_lines) * line_height + 2 * padding
-            
-            # Ограничиваем максимальную высоту текстового блока
-            text_block_height = min(text_block_height, max_text_height)
-            
-            # Создаем новое изображение с увеличенной высотой
-            new_img_height = img_height + text_block_height
-            new_img = Image.new('RGB', (img_width, new_img_height), color=config.background_color)
-            
-            # Вставляем оригинальное изображение в нужную позицию
-            if config.position == 'bottom':
-                new_img.paste(img, (0, 0))
-                text_y_start = img_height
+                    entry = caption_manifest.get(filename)
+                except ValueError as e:
+                    print(f"Ошибка в манифесте подписей для {filename}: {e}")
+                    failed.append({'filename': filename, 'error': str(e)})
+                    continue
+                if entry is None:
+                    # Без подписи изображение пропускается, а не получает чужую
+                    unmatched.append(filename)
+                    continue
+                text, overrides = entry
+                if overrides:
+                    style = style.replace(**overrides)
             else:
-                new_img.paste(img, (0, text_block_height))
-                text_y_start = 0
-            
-            # Создаем объект для рисования на новом изображении
-            draw_new = ImageDraw.Draw(new_img)
-            
-            # Рисуем текст в нужной позиции
-            y_position = text_y_start + padding
-            
-            for line in wrapped_lines:
-                bbox = draw_new.textbbox((0, 0), line, font=font)
-                text_width = bbox[2] - bbox[0]
-                x_position = (img_width - text_width) / 2
-                
-                draw_new.text((x_position, y_position), line, fill=config.text_color, font=font)
-                y_position += line_height
-            
-            # Сохраняем
-            name, ext = os.path.splitext(filename)
-            output_filename = f"{name}_labeled{ext}"
-            output_path = os.path.join(config.output, output_filename)
-            new_img.save(output_path)
-            
-            processed_count += 1
-            
-            # Показываем, какой заголовок использован
-            if config.title_source == 'file':
-                title_source = "расширенный" if i >= (len(titles) - (len(image_files) - len(titles))) and len(titles) < len(image_files) else "оригинальный"
-                print(f"Обработано: {filename} -> {output_filename} ({len(wrapped_lines)} стр., {title_source} заголовок)")
+                text = titles[i] if titles is not None else get_title_from_filename(filename)
+            if incremental:
+                style_hash = settings_hash
+                if style is not settings['style']:
+                    style_hash = style_hashes[filename] = get_settings_hash(settings, style)
+                try:
+                    signature = get_source_signature(os.path.join(config.input, filename))
+                except OSError:
+                    signature = None
+                if signature is not None:
+                    signatures[filename] = signature
+                    entry = old_entries.get(filename)
+                    if is_output_current(entry, signature, text, style_hash, config.output):
+                        manifest_entries[filename] = entry
+                        skipped_count += 1
+                        continue
+            if source is not None:
+                # Из архива читаются только байты; декодирует рабочий процесс
+                try:
+                    data = source.read(filename)
+                except (OSError, KeyError, zipfile.BadZipFile, tarfile.TarError) as e:
+                    print(f"Ошибка при чтении {filename} из архива: {e}")
+                    failed.append({'filename': filename, 'error': str(e)})
+                    continue
+                task_indices.append(i)
+                yield (filename, text, style, settings, data)
             else:
-                print(f"Обработано: {filename} -> {output_filename} ({len(wrapped_lines)} стр., из имени файла)")
-            
-        except Exception as e:
-            print(f"Ошибка при обработке {filename}: {e}")
+                task_indices.append(i)
+                yield (filename, text, style, settings)
+
+    metrics = None
+    if settings['profile']:
+        try:
+            metrics = RunMetrics(getattr(config, 'metrics_file', None))
+        except OSError as e:
+            print(f"Ошибка при открытии файла метрик: {e}")
+            metrics = RunMetrics()
+
+    for result in iter_processed(iter_tasks(), settings, workers, prefetch):
+        i = task_indices.popleft()
+        filename = result['filename']
+        cache_stats[result['pid']] = result['stats']
+        peak_rss[result['pid']] = result['peak_rss']
+        if metrics is not None:
+            metrics.add(result)
+
+        if result['error'] is not None:
+            print(f"Ошибка при обработке {filename}: {result['error']}")
+            failed.append({'filename': filename, 'error': result['error']})
             continue
 
+        if sink is not None:
+            try:
+                for name, data in result['files']:
+                    sink.write(name, data)
+            except (OSError, tarfile.TarError) as e:
+                print(f"Ошибка при записи {filename} в архив: {e}")
+                failed.append({'filename': filename, 'error': str(e)})
+                continue
+
+        processed_count += 1
+        output_bytes += result['output_bytes']
+        if result.get('deduplicated'):
+            dedup_count += 1
+            dedup_bytes += result['saved_bytes']
+            dedup_seconds += result['saved_seconds']
+        if incremental and filename in signatures:
+            manifest_entries[filename] = make_manifest_entry(
+                signatures[filename], result['title'], style_hashes.get(filename, settings_hash),
+                result['output_filename'], result['variant_filenames'])
+        output_filename = result['output_filename']
+        line_count = describe_caption(result, config.style.auto_fit)
+
+        # Показываем, какой заголовок использован
+        if config.title_source == 'file':
+            title_source = "расширенный" if i >= (len(titles) - (len(image_files) - len(titles))) and len(titles) < len(image_files) else "оригинальный"
+            print(f"Обработано: {filename} -> {output_filename} ({line_count}, {title_source} заголовок)")
+        elif config.title_source == 'manifest':
+            print(f"Обработано: {filename} -> {output_filename} ({line_count}, из манифеста)")
+        else:
+            print(f"Обработано: {filename} -> {output_filename} ({line_count}, из имени файла)")
+
+    if metrics is not None:
+        metrics.close()
+
+    if temp_store is not None:
+        shutil.rmtree(temp_store, ignore_errors=True)
+    if source is not None:
+        source.close()
+    if sink is not None:
+        try:
+            sink.close()
+            print(f"Результаты записаны в архив '{config.output}' ({sink.count} файлов)")
+        except (OSError, tarfile.TarError) as e:
+            print(f"Ошибка при закрытии архива '{config.output}': {e}")
+
+    if incremental:
+        try:
+            save_manifest(config.output, manifest_entries, manifest_filename)
+        except OSError as e:
+            print(f"Ошибка при сохранении манифеста: {e}")
+
+    if total_count == 0:
+        print(f"В папке '{config.input}' не найдено изображений!")
+
+    if caption_manifest is not None:
+        caption_manifest.close()
+        report_caption_manifest(caption_manifest, unmatched)
+
+    if shard is not None:
+        summary = {
+            'shard': [shard.index, shard.count],
+            'method': shard.method,
+            'input': config.input,
+            'total': total_count,
+            'processed': processed_count,
+            'skipped': skipped_count,
+            'failed': failed,
+            'unmatched': unmatched,
+            'elapsed_seconds': round(time.perf_counter() - started, 3),
+            'finished': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        try:
+            summary_path = save_shard_summary(config.output, shard, summary)
+            print(f"Сводка шарда {shard} записана в '{summary_path}'")
+        except OSError as e:
+            print(f"Ошибка при сохранении сводки шарда: {e}")
+
     print("-" * 50)
-    print(f"Обработка завершена! Успешно обработано: {processed_count}/{len(image_files)} изображений")
+    print(f"Обработка завершена! Успешно обработано: {processed_count + skipped_count}/{total_count} изображений")
+    if incremental:
+        print(f"Пересобрано: {processed_count}, пропущено без изменений: {skipped_count}")
+    print(f"Профиль кодирования: {ENCODE_PROFILE_NAMES[settings['encode_profile']]}, "
+          f"записано {output_bytes / (1024 * 1024):.1f} МБ")
+    if settings['dedup_store']:
+        print(f"Повторы по содержимому: {dedup_count} изобр. взяты готовыми, "
+              f"сэкономлено {dedup_bytes / (1024 * 1024):.1f} МБ кодирования и записи, {dedup_seconds:.2f} с")
+    for cache_name, label in (('fonts', 'шрифтов'), ('captions', 'подписей')):
+        hits = sum(stats[cache_name][0] for stats in cache_stats.values())
+        misses = sum(stats[cache_name][1] for stats in cache_stats.values())
+        print(format_cache_stats(label, hits, misses))
+
+    # Пиковая память: главный процесс и самый "тяжелый" рабочий процесс
+    peak_rss[os.getpid()] = get_peak_rss()
+    known_peaks = [peak for peak in peak_rss.values() if peak is not None]
+    if known_peaks:
+        print(f"Пиковое потребление памяти: {max(known_peaks) / (1024 * 1024):.1f} МБ на процесс")
+
+    if metrics is not None:
+        metrics.print_summary()
+        if getattr(config, 'metrics_file', None):
+            print(f"Метрики по изображениям записаны в '{config.metrics_file}'")
     
     # Показываем статистику по использованию заголовков
     if config.title_source == 'file' and len(titles) > len(image_files):
         print(f"Использовано {len(image_files)} из {len(titles)} заголовков")
-    elif config.title_source == 'file' and len(titles) < len(image_files) and processed_count == len(image_files):
+    elif config.title_source == 'file' and len(titles) < len(image_files) and processed_count + skipped_count == len(image_files):
         extended_count = len(image_files) - (len(titles) - (len(image_files) - len(titles)))
         print(f"Использовано {len(titles) - extended_count} оригинальных и {extended_count} расширенных заголовков")
-    
-    # Для Windows: оставляем консоль открытой
-    if os.name == 'nt':
-        input("Нажмите Enter для выхода...")
+
 
 if __name__ == "__main__":
+    # Нужно для рабочих процессов в собранном PyInstaller exe
+    multiprocessing.freeze_support()
     main()
\ No newline at end of file
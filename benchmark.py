@@ -0,0 +1,291 @@
+# benchmark.py
+"""Замер производительности Labeler на синтетическом наборе изображений.
+
+Создает набор фотографий разных размеров и форматов с короткими и очень
+длинными подписями (кириллица и латиница), прогоняет его через те же функции,
+что и main(), и сохраняет результаты в JSON для сравнения запусков.
+
+Пример:
+    python benchmark.py --preset quick --results bench_results.json
+
+Нагрузочный прогон запущенного сервиса (Labeler.py --serve):
+    python benchmark.py --server-url http://127.0.0.1:8080 --requests 500 --concurrency 8
+"""
+from PIL import Image, ImageDraw, features
+import PIL
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import platform
+import argparse
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import Labeler
+
+# Размеры изображений: от миниатюр до 50 Мп
+SIZE_PRESETS = {
+    'quick': [(160, 120), (640, 480), (1920, 1080), (4000, 3000)],
+    'full': [(160, 120), (640, 480), (1920, 1080), (4000, 3000), (6000, 4000), (8660, 5774)],
+}
+
+CORPUS_FORMATS = ('jpg', 'png', 'webp', 'tiff')
+
+SHORT_TITLES = [
+    "Закат над озером",
+    "Sunset over the lake",
+]
+
+LONG_TITLES = [
+    ("Семейный праздник в загородном доме: бабушка, дедушка, родители, дети и внуки "
+     "собрались за большим столом, чтобы отметить юбилей. ") * 4,
+    ("A very long archival caption describing the people, the place and the occasion "
+     "in great detail so that the wrapper has to split it into many lines. ") * 4,
+]
+
+def make_photo(width, height, seed):
+    """Синтетическая "фотография": градиент с шумом, чтобы кодировщики работали как на реальных снимках"""
+    rng = random.Random(seed)
+    base = Image.linear_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    red = Image.blend(base, noise, 0.3)
+    green = base.rotate(90 * rng.randint(0, 3)).resize((width, height))
+    blue = Image.blend(noise, base.transpose(Image.FLIP_LEFT_RIGHT), 0.5)
+    img = Image.merge('RGB', (red, green, blue))
+    draw = ImageDraw.Draw(img)
+    for _ in range(8):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = x0 + rng.randrange(width // 4 + 1), y0 + rng.randrange(height // 4 + 1)
+        draw.ellipse((x0, y0, x1, y1), fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    return img
+
+def generate_corpus(folder, sizes, formats, copies=1):
+    """Создание набора изображений и файла заголовков; возвращает путь к titles.txt"""
+    os.makedirs(folder, exist_ok=True)
+    titles = []
+    index = 0
+    for width, height in sizes:
+        for image_format in formats:
+            if image_format == 'webp' and not features.check('webp'):
+                continue
+            for _ in range(copies):
+                img = make_photo(width, height, seed=index)
+                img.save(os.path.join(folder, f"img_{index:04d}_{width}x{height}.{image_format}"))
+                pool = SHORT_TITLES if index % 2 == 0 else LONG_TITLES
+                titles.append(pool[(index // 2) % len(pool)])
+                index += 1
+
+    titles_path = os.path.join(folder, 'titles.txt')
+    with open(titles_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(titles) + '\n')
+    return titles_path
+
+def make_settings(input_folder, output_folder, encode_profile=None, output_format=None):
+    """Те же параметры отрисовки, что использует main() по умолчанию"""
+    font_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'times.ttf')
+    return {
+        'input': input_folder,
+        'output': output_folder,
+        'style': Labeler.LabelStyle(font_path=font_path),
+        'encode_profile': encode_profile,
+        'output_format': output_format,
+        'profile': True,
+    }
+
+def run_benchmark(corpus_folder, titles_path, output_folder, settings):
+    """Прогон набора через конвейер Labeler с замером этапов"""
+    os.makedirs(output_folder, exist_ok=True)
+
+    started = time.perf_counter()
+    image_files = Labeler.get_image_files_sorted(corpus_folder, 'name')
+    discover_time = time.perf_counter() - started
+
+    with open(titles_path, 'r', encoding='utf-8') as f:
+        titles = [line.strip() for line in f if line.strip()]
+
+    style = settings['style']
+    context = Labeler.get_render_context(style.font_path, style.bold)
+    stage_totals = dict.fromkeys(Labeler.PIPELINE_STAGES, 0.0)
+    images = []
+    input_bytes = output_bytes = 0
+
+    run_started = time.perf_counter()
+    for i, filename in enumerate(image_files):
+        timer = Labeler.StageTimer()
+        info = Labeler.label_file(filename, titles[i % len(titles)], style, settings, timer)
+        for stage, duration in timer.durations.items():
+            stage_totals[stage] += duration
+        input_bytes += info['input_bytes']
+        output_bytes += info['output_bytes']
+        images.append({
+            'filename': filename,
+            'pixels': info['pixels'],
+            'lines': info['line_count'],
+            'input_bytes': info['input_bytes'],
+            'output_bytes': info['output_bytes'],
+            'stages': timer.durations,
+        })
+    elapsed = time.perf_counter() - run_started
+
+    stage_totals = dict({'discover': discover_time}, **stage_totals)
+    return {
+        'images': len(images),
+        'elapsed_seconds': elapsed,
+        'images_per_second': len(images) / elapsed if elapsed else 0.0,
+        'input_megabytes_per_second': input_bytes / (1024 * 1024) / elapsed if elapsed else 0.0,
+        'stage_seconds': stage_totals,
+        'font_cache': {'hits': context.fonts.hits, 'misses': context.fonts.misses},
+        'caption_cache': {'hits': context.captions.hits, 'misses': context.captions.misses},
+        'peak_rss_bytes': Labeler.get_peak_rss(),
+        'per_image': images,
+    }
+
+def run_load(server_url, corpus_folder, titles_path, requests_count, concurrency):
+    """Нагрузочный прогон HTTP-сервиса изображениями из набора"""
+    image_files = Labeler.get_image_files_sorted(corpus_folder, 'name')
+    with open(titles_path, 'r', encoding='utf-8') as f:
+        titles = [line.strip() for line in f if line.strip()]
+    payloads = []
+    for i, filename in enumerate(image_files):
+        with open(os.path.join(corpus_folder, filename), 'rb') as f:
+            payloads.append((f.read(), titles[i % len(titles)]))
+
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def send(index):
+        data, title = payloads[index % len(payloads)]
+        url = f"{server_url.rstrip('/')}/label?{urllib.parse.urlencode({'title': title})}"
+        request = urllib.request.Request(url, data=data, method='POST',
+                                         headers={'Content-Type': 'application/octet-stream'})
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, range(requests_count)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    with urllib.request.urlopen(f"{server_url.rstrip('/')}/stats") as response:
+        server_stats = json.loads(response.read().decode('utf-8'))
+    return {
+        'requests': requests_count,
+        'concurrency': concurrency,
+        'elapsed_seconds': elapsed,
+        'requests_per_second': requests_count / elapsed if elapsed else 0.0,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'latency_ms': {name: Labeler.percentile(latencies, fraction) * 1000
+                       for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1.0))},
+        'server_stats': server_stats,
+    }
+
+def print_load_report(results):
+    print("-" * 50)
+    print(f"Запросов: {results['requests']} (параллельно {results['concurrency']}), "
+          f"время: {results['elapsed_seconds']:.2f} с")
+    print(f"Пропускная способность: {results['requests_per_second']:.2f} запр./с")
+    print("Ответы: " + ", ".join(f"{status}: {count}" for status, count in results['statuses'].items()))
+    latency = results['latency_ms']
+    print(f"Задержка: p50 {latency['p50']:.1f} мс, p95 {latency['p95']:.1f} мс, "
+          f"p99 {latency['p99']:.1f} мс, max {latency['max']:.1f} мс")
+
+def get_environment():
+    return {
+        'python': sys.version.split()[0],
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+def print_report(results):
+    print("-" * 50)
+    print(f"Изображений: {results['images']}, время: {results['elapsed_seconds']:.2f} с")
+    print(f"Скорость: {results['images_per_second']:.2f} изобр./с, "
+          f"{results['input_megabytes_per_second']:.2f} МБ/с на входе")
+    print("Время по этапам:")
+    total = sum(results['stage_seconds'].values()) or 1.0
+    for stage, seconds in results['stage_seconds'].items():
+        print(f"  {stage:<10} {seconds:8.3f} с  {seconds * 100 / total:5.1f}%")
+    if results['peak_rss_bytes']:
+        print(f"Пиковое потребление памяти: {results['peak_rss_bytes'] / (1024 * 1024):.1f} МБ")
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Замер производительности добавления подписей')
+    parser.add_argument('--preset', choices=list(SIZE_PRESETS), default='quick',
+                        help='Набор размеров: quick (до 12 Мп) или full (до 50 Мп) (по умолчанию: quick)')
+    parser.add_argument('--formats', nargs='+', choices=CORPUS_FORMATS, default=list(CORPUS_FORMATS),
+                        help='Форматы изображений в наборе')
+    parser.add_argument('--copies', type=int, default=1,
+                        help='Количество изображений каждого размера и формата (по умолчанию: 1)')
+    parser.add_argument('--corpus', default=None,
+                        help='Папка с набором (если не указана, набор создается во временной папке)')
+    parser.add_argument('--encode-profile', choices=list(Labeler.ENCODE_PROFILES), default=None,
+                        help='Профиль кодирования результатов')
+    parser.add_argument('--format', dest='output_format', choices=list(Labeler.OUTPUT_FORMAT_EXTENSIONS),
+                        default=None, help='Принудительный выходной формат')
+    parser.add_argument('--server-url', default=None,
+                        help='Адрес запущенного сервиса (Labeler.py --serve) для нагрузочного прогона')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='Количество запросов нагрузочного прогона (по умолчанию: 200)')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Количество одновременных запросов (по умолчанию: 4)')
+    parser.add_argument('--results', default='bench_results.json',
+                        help='Файл для результатов в формате JSON (по умолчанию: bench_results.json)')
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    workdir = tempfile.mkdtemp(prefix='labeler_bench_')
+    try:
+        corpus_folder = args.corpus or os.path.join(workdir, 'corpus')
+        titles_path = os.path.join(corpus_folder, 'titles.txt')
+        if not os.path.exists(titles_path):
+            print(f"Создание набора изображений в '{corpus_folder}'...")
+            generate_corpus(corpus_folder, SIZE_PRESETS[args.preset], args.formats, args.copies)
+
+        if args.server_url:
+            results = run_load(args.server_url, corpus_folder, titles_path,
+                               args.requests, args.concurrency)
+        else:
+            settings = make_settings(corpus_folder, os.path.join(workdir, 'output'),
+                                     args.encode_profile, args.output_format)
+            results = run_benchmark(corpus_folder, titles_path, settings['output'], settings)
+        results['environment'] = get_environment()
+        results['parameters'] = {
+            'preset': args.preset,
+            'formats': args.formats,
+            'copies': args.copies,
+            'encode_profile': args.encode_profile,
+            'output_format': args.output_format,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.server_url:
+        print_load_report(results)
+    else:
+        print_report(results)
+    with open(args.results, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в '{args.results}'")
+
+if __name__ == "__main__":
+    main()
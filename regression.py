@@ -0,0 +1,331 @@
+# regression.py
+"""Проверка отрисовки подписей по эталонным изображениям.
+
+Фиксированный набор случаев (обе позиции, жирный текст, все цвета из
+select_color, очень длинные и кириллические заголовки, необычные режимы
+изображений) отрисовывается теми же функциями, что и main(), со шрифтом
+times.ttf из папки программы (жирные случаи - DejaVu Serif Bold из
+regression/fonts) и сравнивается с эталонами из папки regression/ с
+допуском. Случаи с одинаковым результатом считаются ошибкой набора.
+Для каждого расхождения сохраняется изображение разницы, а время
+отрисовки каждого случая записывается в результаты, чтобы изменения
+скорости и изменения картинки было видно вместе.
+
+Пример:
+    python regression.py                      # сравнение с эталонами
+    python regression.py --update             # пересоздание эталонов
+    python regression.py --baseline prev.json # сравнение времени с прошлым прогоном
+"""
+from PIL import Image, ImageChops, ImageDraw, ImageFilter, ImageOps
+import PIL
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+
+import Labeler
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FONT_PATH = os.path.join(BASE_DIR, 'times.ttf')
+# Жирный Times с программой не поставляется: для жирных случаев - свободный
+# DejaVu Serif Bold из папки эталонов, чтобы жирный текст действительно отличался
+BOLD_FONT_PATH = os.path.join(BASE_DIR, 'regression', 'fonts', 'DejaVuSerif-Bold.ttf')
+REFERENCE_DIR = os.path.join(BASE_DIR, 'regression')
+
+LONG_CYRILLIC = ("Семейный праздник в загородном доме: бабушка, дедушка, родители, дети и внуки "
+                 "собрались за большим столом, чтобы отметить юбилей. ") * 3
+LONG_LATIN = ("A very long archival caption describing the people, the place and the occasion "
+              "in great detail so that the wrapper has to split it into many lines. ") * 3
+LONG_WORD = "Электрофотографический" * 6
+
+# Режимы исходных изображений и заголовки к ним
+IMAGE_MODES = ('1', 'L', 'LA', 'P', 'PA', 'RGBA', 'CMYK', 'I;16', 'F')
+
+def make_photo(width, height):
+    """Детерминированная синтетическая "фотография": градиенты и фигуры без шума"""
+    horizontal = Image.linear_gradient('L').rotate(90).resize((width, height))
+    vertical = Image.linear_gradient('L').resize((width, height))
+    radial = Image.radial_gradient('L').resize((width, height))
+    img = Image.merge('RGB', (horizontal, vertical, radial))
+    draw = ImageDraw.Draw(img)
+    draw.ellipse((width // 8, height // 8, width // 2, height // 2), fill=(220, 40, 40))
+    draw.rectangle((width // 2, height // 3, width - width // 8, height - height // 8), fill=(30, 90, 200))
+    draw.line((0, height - 1, width - 1, 0), fill=(255, 255, 255), width=3)
+    return img
+
+def convert_mode(img, mode):
+    """Исходное изображение в нужном режиме, в том числе с прозрачностью"""
+    if mode in ('LA', 'RGBA', 'PA'):
+        alpha = Image.linear_gradient('L').resize(img.size)
+        base = img.convert('RGBA')
+        base.putalpha(alpha)
+        if mode == 'PA':
+            # Палитра с отдельным альфа-каналом
+            palette = base.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=64)
+            result = Image.merge('PA', (palette, alpha))
+            result.putpalette(palette.getpalette())
+            return result
+        return base.convert(mode)
+    if mode == 'P':
+        result = img.convert('P', palette=Image.ADAPTIVE, colors=32)
+        # Прозрачный индекс палитры
+        result.info['transparency'] = 0
+        return result
+    if mode == 'I;16':
+        return img.convert('L').convert('I').point(lambda value: value * 256).convert('I;16')
+    return img.convert(mode)
+
+def make_case(name, title, size=(320, 240), mode='RGB', output_format='png', **style):
+    style.setdefault('font_path', BOLD_FONT_PATH if style.get('bold') else FONT_PATH)
+    return {
+        'name': name,
+        'title': title,
+        'size': size,
+        'mode': mode,
+        'output_format': output_format,
+        'style': Labeler.LabelStyle(**style),
+    }
+
+def get_cases():
+    """Фиксированный набор случаев; имена случаев совпадают с именами эталонов"""
+    cases = [
+        make_case('position_bottom', "Закат над озером", position='bottom'),
+        make_case('position_top', "Закат над озером", position='top'),
+        make_case('bold_bottom', "Закат над озером", bold=True),
+        make_case('bold_top', "Закат над озером", position='top', bold=True),
+        make_case('latin_short', "Sunset over the lake"),
+        make_case('cyrillic_letters', "Ёлка, щука, Юрий и Эльза: «ЪЫЬ» — №1"),
+        make_case('long_cyrillic', LONG_CYRILLIC),
+        make_case('long_cyrillic_top', LONG_CYRILLIC, position='top'),
+        make_case('long_latin', LONG_LATIN, size=(640, 480)),
+        make_case('long_word', LONG_WORD),
+        # На высоком изображении базовый шрифт крупнее минимального, и подпись
+        # не помещается: без автоподбора она обрезается, с ним - уменьшается
+        make_case('long_cyrillic_tall', LONG_CYRILLIC, size=(900, 1200)),
+        make_case('long_cyrillic_auto_fit', LONG_CYRILLIC, size=(900, 1200), auto_fit=True),
+        make_case('long_cyrillic_small', LONG_CYRILLIC, size=(120, 90)),
+        make_case('portrait', "Семейный праздник", size=(240, 320)),
+        make_case('large_text', "Закат над озером", size=(800, 1000), text_size_ratio=0.08),
+        make_case('normal_text_tall', "Закат над озером", size=(800, 1000)),
+        make_case('large_image', "Закат над озером", size=(1600, 1200)),
+        make_case('rgba_to_jpeg', "Прозрачность на JPEG", mode='RGBA', output_format='jpeg'),
+        make_case('gray_colors', "Серая подпись", mode='L',
+                  text_color=(255, 255, 255), background_color=(64, 64, 64)),
+    ]
+    # Все предустановленные цвета select_color - как цвет текста и как цвет фона
+    for color_name, color in Labeler.COLORS.items():
+        hex_color = '%02x%02x%02x' % color
+        cases.append(make_case(f'text_{hex_color}', color_name.capitalize(), text_color=color,
+                               background_color=(0, 0, 0) if color == (255, 255, 255) else (255, 255, 255)))
+        cases.append(make_case(f'background_{hex_color}', color_name.capitalize(), background_color=color,
+                               text_color=(0, 0, 0) if sum(color) > 384 else (255, 255, 255)))
+    for mode in IMAGE_MODES:
+        name = 'mode_' + mode.replace(';', '_').lower()
+        cases.append(make_case(name, f"Режим {mode}", mode=mode))
+    return cases
+
+def render_case(case, context, repeat=1):
+    """Отрисовка случая; возвращает (изображение, время первого прогона,
+    лучшее время повторов, длительности этапов первого прогона)"""
+    source = convert_mode(make_photo(*case['size']), case['mode'])
+    output_ext = Labeler.OUTPUT_FORMAT_EXTENSIONS[case['output_format']]
+    times = []
+    stages = None
+    for _ in range(max(1, repeat)):
+        # Готовые полосы не переиспользуются между повторами, шрифты - да
+        context.captions = Labeler.CaptionCache()
+        img = source.copy()
+        timer = Labeler.StageTimer()
+        started = time.perf_counter()
+        result, _ = Labeler.compose_labeled_image(img, case['title'], case['style'], context, output_ext, timer)
+        times.append(time.perf_counter() - started)
+        if stages is None:
+            stages = {stage: seconds * 1000 for stage, seconds in timer.durations.items()}
+    return result, times[0] * 1000, min(times) * 1000, stages
+
+def compare_images(reference, actual, tolerance, blur):
+    """Доля пикселей, отличающихся больше чем на tolerance хотя бы в одном канале,
+    и маска отличий. Размытие на blur пикселей гасит сдвиги сглаживания"""
+    if reference.size != actual.size:
+        return 1.0, None
+    reference = reference.convert('RGBA')
+    actual = actual.convert('RGBA')
+    if blur:
+        reference = reference.filter(ImageFilter.GaussianBlur(blur))
+        actual = actual.filter(ImageFilter.GaussianBlur(blur))
+    difference = ImageChops.difference(reference, actual)
+    channels = difference.split()
+    mask = channels[0]
+    for channel in channels[1:]:
+        mask = ImageChops.lighter(mask, channel)
+    mask = mask.point(lambda value: 255 if value > tolerance else 0)
+    differing = mask.histogram()[255]
+    return differing / (mask.width * mask.height), mask
+
+def make_diff_image(reference, actual, mask):
+    """Эталон, результат и результат с выделенными красным отличиями рядом"""
+    panels = [reference.convert('RGB'), actual.convert('RGB')]
+    if mask is not None:
+        highlighted = ImageOps.grayscale(actual).convert('RGB')
+        highlighted.paste((255, 0, 0), (0, 0), mask)
+        panels.append(highlighted)
+    width = sum(panel.width for panel in panels) + 10 * (len(panels) - 1)
+    height = max(panel.height for panel in panels)
+    diff = Image.new('RGB', (width, height), (255, 255, 255))
+    x = 0
+    for panel in panels:
+        diff.paste(panel, (x, 0))
+        x += panel.width + 10
+    return diff
+
+def run_regression(cases, reference_dir, diff_dir, update, tolerance, max_ratio, blur, repeat):
+    """Прогон всех случаев: сравнение с эталонами или их пересоздание"""
+    contexts = {}
+    results = []
+    for case in cases:
+        style = case['style']
+        key = (style.font_path, style.bold)
+        if key not in contexts:
+            contexts[key] = Labeler.RenderContext(style.font_path, style.bold)
+        actual, first_ms, best_ms, stages = render_case(case, contexts[key], repeat)
+
+        reference_path = os.path.join(reference_dir, case['name'] + '.png')
+        result = {
+            'case': case['name'],
+            'size': list(actual.size),
+            'mode': actual.mode,
+            'first_ms': first_ms,
+            'best_ms': best_ms,
+            'stages_ms': stages,
+            'diff_ratio': 0.0,
+            # Совпадающие результаты разных случаев значат, что случай ничего не проверяет
+            'digest': hashlib.sha1(actual.mode.encode() + bytes(str(actual.size), 'ascii')
+                                   + actual.tobytes()).hexdigest(),
+        }
+        if update:
+            os.makedirs(reference_dir, exist_ok=True)
+            actual.save(reference_path, optimize=True)
+            result['status'] = 'updated'
+        elif not os.path.exists(reference_path):
+            result['status'] = 'missing'
+        else:
+            with Image.open(reference_path) as reference:
+                reference.load()
+            ratio, mask = compare_images(reference, actual, tolerance, blur)
+            result['diff_ratio'] = ratio
+            if ratio <= max_ratio:
+                result['status'] = 'ok'
+            else:
+                result['status'] = 'failed'
+                os.makedirs(diff_dir, exist_ok=True)
+                diff_path = os.path.join(diff_dir, case['name'] + '_diff.png')
+                make_diff_image(reference, actual, mask).save(diff_path)
+                result['diff_image'] = diff_path
+                if reference.size != actual.size:
+                    result['reason'] = (f"размер {actual.size[0]}x{actual.size[1]} "
+                                        f"вместо {reference.size[0]}x{reference.size[1]}")
+        results.append(result)
+    return results
+
+def find_identical_cases(results):
+    """Группы случаев с попиксельно одинаковым результатом"""
+    groups = {}
+    for result in results:
+        groups.setdefault(result['digest'], []).append(result['case'])
+    return [names for names in groups.values() if len(names) > 1]
+
+def load_baseline(path):
+    """Время случаев из результатов прошлого прогона: {случай: лучшее время, мс}"""
+    with open(path, 'r', encoding='utf-8') as f:
+        previous = json.load(f)
+    return {case['case']: case['best_ms'] for case in previous.get('cases', [])}
+
+def print_report(results, baseline=None):
+    print("-" * 78)
+    print(f"{'Случай':<28} {'Статус':<8} {'Отличия':>8} {'Первый':>9} {'Лучший':>9} {'Изменение':>10}")
+    for result in results:
+        change = ''
+        if baseline and baseline.get(result['case']):
+            previous = baseline[result['case']]
+            change = f"{(result['best_ms'] - previous) * 100 / previous:+.1f}%"
+        print(f"{result['case']:<28} {result['status']:<8} {result['diff_ratio'] * 100:7.3f}% "
+              f"{result['first_ms']:7.1f}мс {result['best_ms']:7.1f}мс {change:>10}")
+        if result.get('reason'):
+            print(f"  {result['reason']}")
+        if result.get('diff_image'):
+            print(f"  Разница: {result['diff_image']}")
+    print("-" * 78)
+    statuses = {}
+    for result in results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+    total_ms = sum(result['best_ms'] for result in results)
+    print(f"Случаев: {len(results)} ({', '.join(f'{status}: {count}' for status, count in statuses.items())}), "
+          f"суммарное время: {total_ms:.1f} мс")
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Проверка отрисовки подписей по эталонным изображениям')
+    parser.add_argument('--update', action='store_true',
+                        help='Пересоздать эталоны вместо сравнения')
+    parser.add_argument('--cases', '-k', default=None,
+                        help='Запустить только случаи, в имени которых есть эта строка')
+    parser.add_argument('--references', default=REFERENCE_DIR,
+                        help='Папка с эталонами (по умолчанию: regression рядом со скриптом)')
+    parser.add_argument('--diff-dir', default='regression_diff',
+                        help='Папка для изображений разницы (по умолчанию: regression_diff)')
+    parser.add_argument('--tolerance', type=int, default=24,
+                        help='Допустимое отличие канала пикселя 0-255 (по умолчанию: 24)')
+    parser.add_argument('--max-diff', type=float, default=0.2,
+                        help='Допустимая доля отличающихся пикселей в процентах (по умолчанию: 0.2)')
+    parser.add_argument('--blur', type=float, default=1.0,
+                        help='Радиус размытия перед сравнением, 0 - попиксельно (по умолчанию: 1)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Количество повторов отрисовки для замера времени (по умолчанию: 3)')
+    parser.add_argument('--baseline', default=None,
+                        help='Результаты прошлого прогона для сравнения времени')
+    parser.add_argument('--results', default='regression_results.json',
+                        help='Файл для результатов в формате JSON (по умолчанию: regression_results.json)')
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    cases = get_cases()
+    if args.cases:
+        cases = [case for case in cases if args.cases in case['name']]
+    if not cases:
+        print("Нет случаев для запуска")
+        return 1
+
+    print(f"Случаев: {len(cases)}, шрифт: {FONT_PATH}")
+    results = run_regression(cases, args.references, args.diff_dir, args.update,
+                             args.tolerance, args.max_diff / 100, args.blur, args.repeat)
+    baseline = load_baseline(args.baseline) if args.baseline else None
+    print_report(results, baseline)
+
+    with open(args.results, 'w', encoding='utf-8') as f:
+        json.dump({
+            'environment': {'python': sys.version.split()[0], 'pillow': PIL.__version__},
+            'parameters': {'tolerance': args.tolerance, 'max_diff_percent': args.max_diff,
+                           'blur': args.blur, 'repeat': args.repeat},
+            'cases': results,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в '{args.results}'")
+
+    identical = find_identical_cases(results)
+    for names in identical:
+        print(f"Одинаковый результат у случаев: {', '.join(names)}")
+    if args.update:
+        print(f"Эталоны сохранены в '{args.references}'")
+        return 1 if identical else 0
+    failed = [result['case'] for result in results if result['status'] != 'ok']
+    if failed:
+        print(f"Не прошли проверку: {', '.join(failed)}")
+        return 1
+    if identical:
+        return 1
+    print("Все случаи совпадают с эталонами")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())